@@ -0,0 +1,232 @@
+# Throughput of the audio engine's hot paths: Mixer, WaveGenerator,
+# SpeedModulator, TimeStretcher, NoteGenerator, AudioScheduler and Synth. Runs
+# headless (no audio device is opened and no window is created).
+#   python bench_audio.py [seconds] [block_size]
+#
+# Each case is run one block at a time, the way Audio runs it, into a reused
+# output buffer. For each case this prints:
+#   rt     - realtime factor: seconds of audio generated per second of CPU. Must
+#            stay well above 1 for audio to play without dropouts.
+#   us/blk - average time per block, in microseconds
+#   KB/blk - memory allocated per block, measured as the average peak of
+#            temporary memory (as seen by tracemalloc) while generating one block.
+#            Allocation-free paths show 0.
+
+import sys
+sys.path.append('.')
+sys.path.append('..')
+
+import os
+import os.path
+import time
+import wave
+import tempfile
+import tracemalloc
+import numpy as np
+
+from common.audio import Audio
+from common.mixer import Mixer, generate_into
+from common.wavegen import WaveGenerator, SpeedModulator
+from common.wavesrc import WaveFile, MappedWaveFile, WaveBuffer
+from common.note import NoteGenerator
+from common.timestretch import TimeStretcher
+from common.clock import AudioScheduler, SimpleTempoMap, kTicksPerQuarter
+
+kNumChannels = 2
+kAllocBlocks = 50
+
+# long enough that nothing ends during a benchmark
+kLongTime = 1000.
+
+
+# time generating num_blocks blocks from the generator that make_gen() returns,
+# and measure the allocations of a few more blocks from a second one. Returns
+# the time per block, in microseconds.
+def bench(name, make_gen, seconds, block_size):
+    num_blocks = int(seconds * Audio.sample_rate / block_size)
+    output = np.empty(block_size * kNumChannels, dtype=np.float32)
+
+    gen = make_gen()
+    generate_into(gen, output, block_size, kNumChannels) # warm up
+    t_start = time.perf_counter()
+    for i in range(num_blocks):
+        generate_into(gen, output, block_size, kNumChannels)
+    elapsed = time.perf_counter() - t_start
+
+    # allocations, from a fresh generator since tracemalloc slows things down
+    gen = make_gen()
+    generate_into(gen, output, block_size, kNumChannels)
+    tracemalloc.start()
+    peak_total = 0
+    for i in range(kAllocBlocks):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        generate_into(gen, output, block_size, kNumChannels)
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    rt = num_blocks * block_size / float(Audio.sample_rate) / elapsed
+    us_per_block = 1e6 * elapsed / num_blocks
+    kb_per_block = peak_total / 1024. / kAllocBlocks
+    print('  %-32s %8.1f %10.1f %8.1f' % (name, rt, us_per_block, kb_per_block))
+    return us_per_block
+
+
+# a stereo 16-bit wave file of noise, at the audio sample rate
+def make_test_wave(filepath, seconds):
+    num_frames = int(seconds * Audio.sample_rate)
+    samples = np.random.randint(-8000, 8000, num_frames * 2).astype(np.int16)
+    w = wave.open(filepath, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(Audio.sample_rate)
+    w.writeframes(samples.tobytes())
+    w.close()
+
+
+def bench_mixer(seconds, block_size):
+    for num_gens in (1, 8, 32):
+        def make_gen():
+            mixer = Mixer()
+            for i in range(num_gens):
+                mixer.add(NoteGenerator(48 + i, 0.1, kLongTime))
+            return mixer
+        bench('Mixer, %d notes' % num_gens, make_gen, seconds, block_size)
+
+
+def bench_wave(seconds, block_size, filepath):
+    sources = (('WaveFile', WaveFile), ('MappedWaveFile', MappedWaveFile),
+               ('WaveBuffer', WaveBuffer))
+    for name, source in sources:
+        bench('WaveGenerator(%s)' % name,
+              lambda: WaveGenerator(source(filepath), loop = True), seconds, block_size)
+
+
+# a WaveGenerator whose gain is always ramping, like a track being muted and
+# unmuted on every block
+class RampingGenerator(object):
+    def __init__(self, gen):
+        super(RampingGenerator, self).__init__()
+        self.gen = gen
+        self.mute = False
+
+    def generate_into(self, output, num_frames, num_channels):
+        self.mute = not self.mute
+        self.gen.set_gain(0.0 if self.mute else 1.0, 0.03)
+        return self.gen.generate_into(output, num_frames, num_channels)
+
+
+def bench_gain(seconds, block_size, filepath):
+    bench('WaveGenerator, gain ramps',
+          lambda: RampingGenerator(WaveGenerator(WaveBuffer(filepath), loop = True)),
+          seconds, block_size)
+
+
+def bench_speed(seconds, block_size, filepath):
+    for mode in ('linear', 'sinc'):
+        for speed in (0.5, 0.87, 1.5):
+            bench('SpeedModulator, %s %g' % (mode, speed),
+                  lambda: SpeedModulator(WaveGenerator(WaveBuffer(filepath), loop = True),
+                                         speed, mode),
+                  seconds, block_size)
+
+
+def bench_stretch(seconds, block_size, filepath):
+    for rate in (0.5, 0.8, 1.25):
+        bench('TimeStretcher, rate %g' % rate,
+              lambda: TimeStretcher(WaveBuffer(filepath), rate, loop = True),
+              seconds, block_size)
+
+
+# the wavetable's speedup over summing sines grows with the number of
+# harmonics. The target is about 5x for saw (9 harmonics); the lookup itself
+# is a fixed dozen or so numpy calls per block, which sets the floor.
+def bench_notes(seconds, block_size):
+    tables = (('sine', NoteGenerator.sine), ('square', NoteGenerator.square),
+              ('saw', NoteGenerator.saw), ('tri', NoteGenerator.tri))
+    times = {}
+    for wavetable in (False, True):
+        for name, harmonics in tables:
+            times[name, wavetable] = \
+                bench('NoteGenerator, %s%s' % (name, ' (table)' if wavetable else ''),
+                      lambda: NoteGenerator(60, 0.5, kLongTime, harmonics = harmonics,
+                                            wavetable = wavetable),
+                      seconds, block_size)
+    print('  wavetable speedup: ' + ', '.join('%s %.1fx' % (name, times[name, False] / times[name, True])
+                                              for name, harmonics in tables))
+
+
+# a command on every tick (~960 per second at 120 bpm), with a new note every
+# 16th note on top of that
+def bench_scheduler(seconds, block_size):
+    def noop(tick, arg):
+        pass
+
+    def make_gen():
+        tempo_map = SimpleTempoMap(120)
+        sched = AudioScheduler(tempo_map)
+        mixer = Mixer()
+        sched.set_generator(mixer)
+
+        def note_on(tick, pitch):
+            mixer.add(NoteGenerator(pitch, 0.1, 0.2))
+
+        num_ticks = int(tempo_map.time_to_tick(seconds + 1.))
+        for tick in range(num_ticks):
+            sched.post_at_tick(noop, tick)
+        for tick in range(0, num_ticks, kTicksPerQuarter // 4):
+            sched.post_at_tick(note_on, tick, 60 + tick % 12)
+        return sched
+
+    bench('AudioScheduler, dense', make_gen, seconds, block_size)
+
+
+# needs the FluidSynth library and a soundfont; skipped if either is missing
+def bench_synth(seconds, block_size):
+    sf2_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/FluidR3_GM.sf2')
+    try:
+        from common.synth import Synth
+    except Exception as e:
+        print('  Synth: skipped (%s)' % e)
+        return
+    if not os.path.exists(sf2_path):
+        print('  Synth: skipped (no soundfont at %s)' % sf2_path)
+        return
+
+    def make_gen():
+        synth = Synth(sf2_path)
+        for pitch in (48, 55, 60, 64, 67, 72):
+            synth.noteon(0, pitch, 100)
+        return synth
+
+    bench('Synth, 6 notes', make_gen, seconds, block_size)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    print('%g seconds of audio per case, %d frames per block, %d Hz' %
+          (seconds, block_size, Audio.sample_rate))
+    print('  %-32s %8s %10s %8s' % ('case', 'rt', 'us/blk', 'KB/blk'))
+
+    tmp_dir = tempfile.mkdtemp()
+    filepath = os.path.join(tmp_dir, 'bench.wav')
+    make_test_wave(filepath, 30.)
+
+    try:
+        bench_mixer(seconds, block_size)
+        bench_wave(seconds, block_size, filepath)
+        bench_gain(seconds, block_size, filepath)
+        bench_speed(seconds, block_size, filepath)
+        bench_stretch(seconds, block_size, filepath)
+        bench_notes(seconds, block_size)
+        bench_scheduler(seconds, block_size)
+        bench_synth(seconds, block_size)
+    finally:
+        # may fail on Windows while the file is still mapped
+        try:
+            os.remove(filepath)
+            os.rmdir(tmp_dir)
+        except OSError:
+            pass
@@ -0,0 +1,59 @@
+# Posts and drains a large number of commands through AudioScheduler's
+# command queue. Runs headless (no audio device is opened).
+#   python bench_scheduler.py [num_commands]
+
+import sys
+sys.path.append('.')
+sys.path.append('..')
+
+import time
+import random
+from common.clock import AudioScheduler, SimpleTempoMap
+
+
+def noop(tick, arg):
+    pass
+
+def bench_post_and_drain(num_commands, block_size = 512):
+    sched = AudioScheduler(SimpleTempoMap(120))
+    max_tick = num_commands * 10
+    ticks = [random.randrange(max_tick) for i in range(num_commands)]
+
+    # post
+    t_start = time.perf_counter()
+    cmds = [sched.post_at_tick(noop, t) for t in ticks]
+    t_post = time.perf_counter() - t_start
+
+    # cancel 10% of them, like Arpeggiator.stop() does
+    removed = cmds[::10]
+    t_start = time.perf_counter()
+    for cmd in removed:
+        sched.remove(cmd)
+    t_remove = time.perf_counter() - t_start
+
+    # drain by running the scheduler until all commands are done
+    t_start = time.perf_counter()
+    while len(sched.commands):
+        sched.generate(block_size, 2)
+    t_drain = time.perf_counter() - t_start
+
+    print('%d commands:' % num_commands)
+    print('  post:   %8.1f ms  (%.2f us / command)' % (1000 * t_post, 1e6 * t_post / num_commands))
+    print('  remove: %8.1f ms  (%.2f us / command)' % (1000 * t_remove, 1e6 * t_remove / len(removed)))
+    print('  drain:  %8.1f ms  (%.2f us / command)' % (1000 * t_drain, 1e6 * t_drain / num_commands))
+
+# commands with the same tick must run in the order they were posted
+def check_stable_order():
+    sched = AudioScheduler(SimpleTempoMap(120))
+    order = []
+    for i in range(1000):
+        sched.post_at_tick(lambda tick, arg: order.append(arg), (i % 7) * 100, i)
+    while len(sched.commands):
+        sched.generate(512, 2)
+    assert order == sorted(order, key = lambda i: ((i % 7), i)), 'unstable order'
+
+
+if __name__ == "__main__":
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    check_stable_order()
+    bench_post_and_drain(num)
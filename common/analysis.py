@@ -0,0 +1,237 @@
+import numpy as np
+from collections import deque
+from .audio import Audio
+from .ringbuf import RingBuffer
+from .fftutil import rfft_into, irfft_into
+
+# Live analysis of audio input (ie, a microphone).
+#
+# InputBuffer keeps the last few seconds of (mono) input in a preallocated
+# RingBuffer - pass its write method to Audio as input_func. InputAnalyzer
+# then steps through that history in fixed-size hops and hands each window
+# of audio to a list of features (RMSFeature, OnsetFeature, PitchFeature, or
+# anything with a process(frame, spectrum, time) method):
+#
+#   self.input = InputBuffer()
+#   self.audio = Audio(2, input_func = self.input.write)
+#   self.pitch = PitchFeature()
+#   self.analyzer = InputAnalyzer(self.input, [RMSFeature(), self.pitch])
+#   ...
+#   def on_update(self):
+#       self.audio.on_update()
+#       self.analyzer.on_update()
+#       print(self.pitch.value)
+
+
+# Recent history of audio input, as mono samples.
+class InputBuffer(object):
+    def __init__(self, seconds = 2.0):
+        super(InputBuffer, self).__init__()
+        self.ring = RingBuffer(int(seconds * Audio.sample_rate))
+
+    # use as Audio's input_func. Stereo input keeps only the left channel.
+    def write(self, data, num_channels):
+        if num_channels == 2:
+            data = data[0::2]
+        self.ring.overwrite(data)
+
+    # total number of samples written so far
+    def get_sample_count(self):
+        return self.ring.write_count
+
+    # copy the len(output) most recent samples into output (or the ones ending
+    # at end_count). Returns False if they are not available.
+    def read(self, output, end_count = None):
+        if end_count is None:
+            end_count = self.ring.write_count
+        return self.ring.read_at(output, end_count)
+
+
+class InputAnalyzer(object):
+    def __init__(self, input_buffer, features, hop_size = 512, window_size = 1024):
+        super(InputAnalyzer, self).__init__()
+        self.input = input_buffer
+        self.features = features
+        self.hop_size = hop_size
+        self.window_size = window_size
+
+        # analysis buffers, reused for every hop
+        self.frame = np.zeros(window_size, dtype=np.float32)
+        # (the FFT is done in float64: a float32 input makes np.fft convert it
+        # into a new array every time)
+        self.windowed = np.zeros(window_size)
+        self.window = np.hanning(window_size)
+        self.spec = np.zeros(window_size // 2 + 1, dtype=np.complex128)
+        self.mag = np.zeros(window_size // 2 + 1)
+        self.need_spectrum = any(getattr(f, 'need_spectrum', False) for f in features)
+
+        # sample count at which the next window ends
+        self.next_end = window_size
+
+    # analyze all complete hops received since the last call. Call every frame.
+    # Returns the number of hops analyzed.
+    def on_update(self):
+        num_hops = 0
+        while self.input.get_sample_count() >= self.next_end:
+            if self.input.read(self.frame, self.next_end):
+                spectrum = self._spectrum() if self.need_spectrum else None
+                time = self.next_end / float(Audio.sample_rate)
+                for f in self.features:
+                    f.process(self.frame, spectrum, time)
+                num_hops += 1
+                self.next_end += self.hop_size
+            else:
+                # fell too far behind and the audio was overwritten. Skip ahead
+                # to the newest complete window.
+                behind = self.input.get_sample_count() - self.next_end
+                self.next_end += (behind // self.hop_size) * self.hop_size
+        return num_hops
+
+    # magnitude spectrum of the windowed frame. The returned array is reused,
+    # so it is only valid until the next hop.
+    def _spectrum(self):
+        self.windowed[:] = self.frame
+        self.windowed *= self.window
+        rfft_into(self.windowed, self.spec)
+        return np.abs(self.spec, out=self.mag)
+
+
+# root-mean-square level of each window
+class RMSFeature(object):
+    need_spectrum = False
+
+    def __init__(self):
+        super(RMSFeature, self).__init__()
+        self.value = 0.0
+
+    def process(self, frame, spectrum, time):
+        self.value = np.sqrt(np.dot(frame, frame) / len(frame))
+
+
+# detects note onsets from the spectral flux (total increase in log magnitude
+# across bins) between windows. An onset is when the flux is more than
+# sensitivity times the recent average flux plus min_flux. Onset times (in
+# seconds of input) are kept in self.onsets, and callback(time) is called
+# for each one if given.
+class OnsetFeature(object):
+    need_spectrum = True
+
+    def __init__(self, callback = None, sensitivity = 2.0, min_flux = 10.0, min_gap = 0.05):
+        super(OnsetFeature, self).__init__()
+        self.callback = callback
+        self.sensitivity = sensitivity
+        self.min_flux = min_flux
+        self.min_gap = min_gap
+
+        self.onsets = deque(maxlen = 64)
+        self.value = 0.0      # current flux
+        self.average = 0.0    # running average flux
+        self.mag = None
+        self.prev_mag = None
+        self.diff = None
+        self.last_onset = -1e9
+
+    def process(self, frame, spectrum, time):
+        if self.mag is None:
+            self.mag = np.zeros_like(spectrum)
+            self.prev_mag = np.zeros_like(spectrum)
+            self.diff = np.zeros_like(spectrum)
+
+        # log magnitude, so quiet and loud notes count about the same
+        np.log1p(spectrum, out=self.mag)
+        np.subtract(self.mag, self.prev_mag, out=self.diff)
+        np.maximum(self.diff, 0, out=self.diff)
+        self.value = self.diff.sum()
+        self.mag, self.prev_mag = self.prev_mag, self.mag
+
+        threshold = self.average * self.sensitivity + self.min_flux
+        if self.value > threshold and time - self.last_onset > self.min_gap:
+            self.last_onset = time
+            self.onsets.append(time)
+            if self.callback:
+                self.callback(time)
+
+        a = 0.9
+        self.average = a * self.average + (1 - a) * self.value
+
+
+# fundamental frequency by autocorrelation (computed with an FFT). value is
+# the pitch in Hz, or 0 if the window is not clearly pitched (its normalized
+# autocorrelation peak is below min_clarity).
+class PitchFeature(object):
+    need_spectrum = False
+
+    def __init__(self, min_freq = 60.0, max_freq = 1000.0, min_clarity = 0.6):
+        super(PitchFeature, self).__init__()
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.min_clarity = min_clarity
+        self.value = 0.0
+        self.clarity = 0.0
+        self.overlap = None
+
+    # buffers for a window of n samples, with periods of lo to hi samples
+    # searched, reused for every hop
+    def _alloc(self, n, lo, hi):
+        self.padded = np.zeros(2 * n)
+        self.power = np.zeros(n + 1, dtype=np.complex128)
+        self.conj = np.zeros(n + 1, dtype=np.complex128)
+        self.full_ac = np.zeros(2 * n)
+        # unbiased: divide each lag by the number of samples that overlap
+        self.overlap = np.arange(n, 0, -1, dtype=np.float64)
+
+        self.lags = (lo, hi)
+        m = max(hi - lo - 2, 0)
+        self.peaks = np.zeros(m)
+        self.is_peak = np.zeros(m, dtype=bool)
+        self.mask = np.zeros(m, dtype=bool)
+
+    def process(self, frame, spectrum, time):
+        n = len(frame)
+        lo = int(Audio.sample_rate / self.max_freq)
+        hi = min(int(Audio.sample_rate / self.min_freq), n - 2)
+        if self.overlap is None or len(self.overlap) != n or self.lags != (lo, hi):
+            self._alloc(n, lo, hi)
+
+        # autocorrelation = inverse FFT of the power spectrum. Zero-pad to 2n so
+        # it doesn't wrap around (the second half of padded stays zero).
+        self.padded[:n] = frame
+        power = self.power
+        rfft_into(self.padded, power)
+        np.conjugate(power, out=self.conj)
+        power *= self.conj
+        irfft_into(power, 2 * n, self.full_ac)
+        ac = self.full_ac[:n]
+        ac /= self.overlap
+
+        self.value = 0.0
+        self.clarity = 0.0
+        if ac[0] <= 0 or hi - lo < 3:
+            return
+
+        # local peaks of the lags in between lo and hi, with the other lags at
+        # -inf in self.peaks
+        seg = ac[lo:hi]
+        mid = seg[1:-1]
+        np.greater(mid, seg[:-2], out=self.is_peak)
+        np.greater_equal(mid, seg[2:], out=self.mask)
+        self.is_peak &= self.mask
+        self.peaks.fill(-np.inf)
+        np.copyto(self.peaks, mid, where=self.is_peak)
+
+        # multiples of the period correlate about as well as the period itself,
+        # so take the first peak that is close to the highest one
+        best = self.peaks.max()
+        if best <= 0:
+            return
+        np.greater_equal(self.peaks, 0.9 * best, out=self.mask)
+        lag = lo + 1 + int(np.argmax(self.mask))
+        self.clarity = ac[lag] / ac[0]
+        if self.clarity < self.min_clarity:
+            return
+
+        # parabolic interpolation around the peak for a sub-sample lag
+        y0, y1, y2 = ac[lag - 1], ac[lag], ac[lag + 1]
+        denom = y0 - 2 * y1 + y2
+        shift = 0.5 * (y0 - y2) / denom if denom != 0 else 0.0
+        self.value = Audio.sample_rate / (lag + shift)
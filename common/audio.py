@@ -14,9 +14,11 @@ sys.path.append('..')
 
 import pyaudio
 import numpy as np
-from common import core
+from common.mixer import generate_into
 import time
 import os.path
+import traceback
+from collections import deque
 from configparser import ConfigParser
 
 
@@ -24,17 +26,39 @@ class Audio(object):
     # global variable: might change when Audio driver is set up.
     sample_rate = 44100
 
-    def __init__(self, num_channels, listen_func = None, input_func = None):
+    # use_callback = True runs the generator chain from PortAudio's own audio
+    # thread instead of from on_update(), so the audio deadline no longer
+    # depends on the frame rate. buffer_size, if given, overrides the config file.
+    def __init__(self, num_channels, listen_func = None, input_func = None,
+                 use_callback = False, buffer_size = None):
         super(Audio, self).__init__()
 
         assert(num_channels == 1 or num_channels == 2)
         self.num_channels = num_channels
         self.listen_func = listen_func
         self.input_func = input_func
+        self.use_callback = use_callback
         self.audio = pyaudio.PyAudio()
 
-        out_dev, in_dev, buffer_size, sr = self._get_parameters()
+        self.generator = None
+        self.cpu_time = 0
+
+        # optional PerfMonitor, for deadline misses and starvation
+        self.monitor = None
+
+        # output buffer handed to the generator chain, reused for every buffer
+        self.out_buf = np.empty(0, dtype=np.float32)
+
+        # callback mode: commands posted from the main thread for the audio
+        # thread, and buffers handed back from the audio thread for listen_func
+        # and input_func. deque append / popleft are atomic, so no locks needed.
+        self.commands = deque()
+        self.listen_queue = deque()
+        self.input_queue = deque()
+
+        out_dev, in_dev, buffer_size, sr = self._get_parameters(buffer_size)
         Audio.sample_rate = sr
+        self.buffer_size = buffer_size
 
         # create stream
         self.stream = self.audio.open(format = pyaudio.paFloat32,
@@ -44,10 +68,24 @@ class Audio(object):
                                       output = True,
                                       input = input_func != None,
                                       output_device_index = out_dev,
-                                      input_device_index = in_dev)
-
-        self.generator = None
-        self.cpu_time = 0
+                                      input_device_index = in_dev,
+                                      stream_callback = self._callback if use_callback else None)
+
+        # seconds from generating a buffer to hearing its first frame. Updated
+        # for every buffer (see get_output_latency).
+        self.stream_latency = self.stream.get_output_latency()
+        self.output_latency = self.stream_latency
+
+        # on_update mode: nothing has been written yet, so all of the stream's
+        # buffer is free. Seeing this much free again later means it ran dry.
+        self.write_buffer_frames = 0
+        self.has_written = False
+        if not use_callback:
+            self.write_buffer_frames = self.stream.get_write_available()
+
+        # imported here rather than at the top, so that modules which only need
+        # Audio.sample_rate (offline rendering, benchmarks) don't create a window
+        from common import core
         core.register_terminate_func(self.close)
 
     def close(self) :
@@ -59,14 +97,49 @@ class Audio(object):
     # generate(num_frames, num_channels), 
     # which returns a numpy array of length (num_frames * num_channels)
     def set_generator(self, gen) :
+        self.post(self._set_generator, gen)
+
+    def _set_generator(self, gen) :
         self.generator = gen
 
+    # run func(*args) from the audio thread, just before the next buffer is
+    # generated. Use this to change the generator chain (add to a Mixer, change
+    # gains, etc.) in callback mode. In on_update mode, func is called right away.
+    def post(self, func, *args) :
+        if self.use_callback:
+            self.commands.append((func, args))
+        else:
+            func(*args)
+
     # return cpu time calcuating audio time in milliseconds
     def get_cpu_load(self) :
         return 1000 * self.cpu_time
 
+    # seconds between generating the most recent buffer and its first frame
+    # coming out of the speakers. In callback mode, this comes from the stream's
+    # timing info for each buffer. In on_update mode, it is the stream's latency
+    # less the part of its buffer that was free (and so is being filled now).
+    # Either way, the calibrated output offset (see calibrate.py) is added, for
+    # the delay that the driver doesn't report.
+    def get_output_latency(self) :
+        return self.output_latency + self.output_offset
+
+    # calibrated seconds from the player tapping (a key, the mouse) to the
+    # event arriving. Subtract from the song time when checking a hit.
+    def get_input_offset(self) :
+        return self.input_offset
+
+    # set a PerfMonitor (see perf.py) to record buffer render times, deadline
+    # misses and starvation, or None to stop recording.
+    def set_monitor(self, monitor) :
+        self.monitor = monitor
+
     # must call this every frame.
     def on_update(self):
+        if self.use_callback:
+            self._dispatch_queues()
+            return
+
         t_start = time.time()
 
         # get input audio if desired
@@ -75,7 +148,7 @@ class Audio(object):
                 num_frames = self.stream.get_read_available() # number of frames to ask for
                 if num_frames:
                     data_str = self.stream.read(num_frames, False)
-                    data_np = np.fromstring(data_str, dtype=np.float32)
+                    data_np = np.frombuffer(data_str, dtype=np.float32)
                     self.input_func(data_np, self.num_channels)
             except IOError as e:
                 print('got error', e)
@@ -83,20 +156,23 @@ class Audio(object):
         # Ask the generator to generate some audio samples.
         num_frames = self.stream.get_write_available() # number of frames to supply
         if self.generator and num_frames != 0:
-            (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
+            self.output_latency = max(self.stream_latency - float(num_frames) / Audio.sample_rate, 0.)
+            if self.monitor:
+                self._check_starved(num_frames)
+                t_gen = time.perf_counter()
 
-            # make sure we got the correct number of frames that we requested
-            assert len(data) == num_frames * self.num_channels, \
-                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+            (data, continue_flag) = self._generate(num_frames)
 
-            # convert type if needed and write to stream
-            if data.dtype != np.float32:
-                data = data.astype(np.float32)
-            self.stream.write(data.tostring())
+            if self.monitor:
+                self.monitor.record_buffer(num_frames, time.perf_counter() - t_gen,
+                                           float(num_frames) / Audio.sample_rate)
+            self.stream.write(data.tobytes())
+            self.has_written = True
 
-            # send data to listerner as well
+            # send data to listerner as well. data is reused on the next
+            # buffer, so the listener gets its own copy.
             if self.listen_func:
-                self.listen_func(data, self.num_channels)
+                self.listen_func(data.copy(), self.num_channels)
 
             # continue flag
             if not continue_flag:
@@ -107,17 +183,101 @@ class Audio(object):
         a = 0.9
         self.cpu_time = a * self.cpu_time + (1-a) * dt
 
+    # called by PortAudio on its audio thread (callback mode only). Must return
+    # exactly frame_count frames and must not wait on the main thread.
+    def _callback(self, in_data, frame_count, time_info, status):
+        t_start = time.time()
+
+        # some host APIs don't fill in time_info. Then use the stream's latency.
+        latency = time_info['output_buffer_dac_time'] - time_info['current_time']
+        self.output_latency = latency if latency > 0 else self.stream_latency
+
+        # apply commands posted from the main thread
+        while self.commands:
+            func, args = self.commands.popleft()
+            func(*args)
+
+        # input audio is handed to input_func on the main thread
+        if self.input_func and in_data:
+            self.input_queue.append(np.frombuffer(in_data, dtype=np.float32))
+
+        data = None
+        if self.generator:
+            try:
+                (data, continue_flag) = self._generate(frame_count)
+                if not continue_flag:
+                    self.generator = None
+            except Exception:
+                # an exception here would silently kill the stream. Report it
+                # and drop the generator instead.
+                traceback.print_exc()
+                self.generator = None
+                data = None
+
+        if data is None:
+            data = self._silence(frame_count)
+
+        if self.listen_func:
+            self.listen_queue.append(data.copy())
+
+        dt = time.time() - t_start
+        a = 0.9
+        self.cpu_time = a * self.cpu_time + (1-a) * dt
+
+        if self.monitor:
+            if status & pyaudio.paOutputUnderflow:
+                self.monitor.record_starved()
+            self.monitor.record_buffer(frame_count, dt, float(frame_count) / Audio.sample_rate)
+
+        return (data.tobytes(), pyaudio.paContinue)
+
+    # on_update mode: if all of the stream's buffer is free, everything written
+    # before has already played, so the output ran dry.
+    def _check_starved(self, num_frames):
+        if self.has_written and num_frames == self.write_buffer_frames:
+            self.monitor.record_starved()
+
+    # run the generator chain into self.out_buf (float32), returning
+    # (data, continue_flag). data is only valid until the next call.
+    def _generate(self, num_frames):
+        data = self._get_out_buf(num_frames)
+        continue_flag = generate_into(self.generator, data, num_frames, self.num_channels)
+        return (data, continue_flag)
+
+    def _silence(self, num_frames):
+        data = self._get_out_buf(num_frames)
+        data.fill(0)
+        return data
+
+    def _get_out_buf(self, num_frames):
+        size = num_frames * self.num_channels
+        if len(self.out_buf) < size:
+            self.out_buf = np.empty(size, dtype=np.float32)
+        return self.out_buf[:size]
+
+    # callback mode: deliver buffers from the audio thread to listen_func and
+    # input_func on the main thread
+    def _dispatch_queues(self):
+        while self.input_queue:
+            self.input_func(self.input_queue.popleft(), self.num_channels)
+        while self.listen_queue:
+            self.listen_func(self.listen_queue.popleft(), self.num_channels)
+
 
     # return parameter values for output device idx, input device idx, and
     # buffer size
-    def _get_parameters(self):
+    def _get_parameters(self, buffer_size = None):
         config = load_audio_config(self.audio)
 
         out_dev     = config['outputdevice']
         in_dev      = config['inputdevice']
-        buf_size    = config['buffersize']
+        buf_size    = config['buffersize'] if buffer_size is None else buffer_size
         sample_rate = config['samplerate']
 
+        # calibrated offsets are in milliseconds in the config file
+        self.output_offset = config['outputoffset'] / 1000.
+        self.input_offset  = config['inputoffset'] / 1000.
+
         # for Windows, we want to find the ASIO host API and associated devices
         if out_dev == 'None':
             cnt = self.audio.get_host_api_count()
@@ -138,12 +298,17 @@ class Audio(object):
         print('using audio params:')
         print('  samplerate: {}\n  buffersize: {}\n  outputdevice: {}\n  inputdevice: {}'.format(
             sample_rate, buf_size, out_dev, in_dev))
+        print('  outputoffset: {}ms\n  inputoffset: {}ms'.format(
+            config['outputoffset'], config['inputoffset']))
         return out_dev, in_dev, buf_size, sample_rate
 
 
 # location of config file (in User's home directory)
 CONFIG_FILE = os.path.expanduser('~/audio_config.cfg')
 
+# directory for cached, precomputed audio data (also in User's home directory)
+CACHE_DIR = os.path.expanduser('~/audio_cache')
+
 
 # load config file. If not found or missing items, will setup default values
 def load_audio_config(py_audio = None):
@@ -176,6 +341,13 @@ def load_audio_config(py_audio = None):
     if 'samplerate' not in out:
         out['samplerate'] = 44100
 
+    # latency offsets in milliseconds, measured by calibrate.py
+    if 'outputoffset' not in out:
+        out['outputoffset'] = 0
+
+    if 'inputoffset' not in out:
+        out['inputoffset'] = 0
+
     # make sure input and output devices are valid:
     if out['outputdevice'] != 'None' and out['outputdevice'] >= len(devices['output']):
         out['outputdevice'] = 'None'
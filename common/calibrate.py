@@ -0,0 +1,177 @@
+# Measures latency by having the player tap the spacebar in time, and saves
+# the result to the audio config file (see load_audio_config) as outputoffset
+# and inputoffset, in milliseconds. Audio applies them from then on
+# (Audio.get_output_latency, Audio.get_input_offset).
+#
+# There are two rounds:
+# 1. tap on each flash of the screen. The taps arrive late by the input offset.
+# 2. tap on each metronome click. The taps arrive late by the input offset plus
+#    whatever output latency the audio driver doesn't report.
+
+# common import
+import sys
+import time
+sys.path.append('.')
+sys.path.append('..')
+
+import numpy as np
+from common.core import *
+from common.audio import *
+from common.mixer import generate_into
+from common.synth import *
+from common.clock import *
+from common.metro import *
+from common.gfxutil import *
+
+from kivy.core.window import Window
+from kivy.graphics import Color, Rectangle
+
+kBPM = 100
+kNumTaps = 16       # taps measured in each round
+kSkipTaps = 4       # taps ignored at the start of a round, to find the beat
+kFlashTime = 0.1    # seconds for a flash to fade out
+kClickPitch = 76    # hi wood block, which has a sharp attack
+
+
+# Passes audio through from an AudioScheduler, remembering when each buffer was
+# rendered. This tells which moment of the click track is being heard at a
+# given time (like MultiTrackGenerator.get_time).
+class ClickTrack(object):
+    def __init__(self, sched):
+        super(ClickTrack, self).__init__()
+        self.sched = sched
+        self.rendered = (0, time.perf_counter())
+
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, output, num_frames, num_channels) :
+        self.rendered = (self.sched.cur_frame, time.perf_counter())
+        return generate_into(self.sched, output, num_frames, num_channels)
+
+    # scheduler time, in seconds, being heard at perf_counter() time t
+    def get_time(self, t, latency):
+        frame, t_render = self.rendered
+        return float(frame) / Audio.sample_rate + t - t_render - latency
+
+
+# how late each tap was, compared to the nearest beat. Times in seconds.
+def tap_errors(tap_times, beat_times):
+    beats = np.array(beat_times)
+    errors = []
+    for t in tap_times:
+        errors.append(t - beats[np.argmin(np.abs(beats - t))])
+    return np.array(errors)
+
+
+class MainWidget(BaseWidget) :
+    def __init__(self):
+        super(MainWidget, self).__init__()
+
+        self.audio = Audio(2)
+        self.synth = Synth('../data/FluidR3_GM.sf2')
+        self.tempo_map = SimpleTempoMap(kBPM)
+        self.sched = AudioScheduler(self.tempo_map)
+        self.sched.set_generator(self.synth)
+        self.click_track = ClickTrack(self.sched)
+        self.audio.set_generator(self.click_track)
+        self.metro = Metronome(self.sched, self.synth, pitch = kClickPitch)
+        self.beat_len = 60. / kBPM
+
+        # full screen flash
+        self.flash_color = Color(1, 1, 1, 0)
+        self.canvas.add(self.flash_color)
+        self.canvas.add(Rectangle(pos = (0, 0), size = (Window.width, Window.height)))
+
+        self.label = topleft_label()
+        self.add_widget(self.label)
+
+        self.input_offset = None
+        self.output_offset = None
+        self._set_state('start')
+
+    def _set_state(self, state):
+        self.state = state
+        self.taps = []
+        self.beats = []
+
+        if state == 'flash':
+            self.next_flash = time.perf_counter() + self.beat_len
+        elif state == 'click':
+            self.metro.start()
+
+    def on_key_down(self, keycode, modifiers):
+        if keycode[1] != 'spacebar':
+            return
+        t = time.perf_counter()
+
+        if self.state in ('start', 'done'):
+            self._set_state('flash')
+
+        elif self.state == 'flash':
+            self.taps.append(t)
+            if len(self.taps) == kSkipTaps + kNumTaps:
+                errors = tap_errors(self.taps[kSkipTaps:], self.beats)
+                self.input_offset = np.median(errors)
+                self.input_spread = np.std(errors)
+                self._set_state('click')
+
+        elif self.state == 'click':
+            self.taps.append(self.click_track.get_time(t, self.audio.get_output_latency()))
+            if len(self.taps) == kSkipTaps + kNumTaps:
+                self.metro.stop()
+                num_beats = int(self.taps[-1] / self.beat_len) + 2
+                errors = tap_errors(self.taps[kSkipTaps:],
+                                    np.arange(num_beats) * self.beat_len)
+                # what's left after the input offset is output latency that
+                # Audio doesn't know about yet
+                self.output_offset = self.audio.output_offset + np.median(errors) - self.input_offset
+                self.output_spread = np.std(errors)
+                self._save()
+                self._set_state('done')
+
+    # save to the config file, and use the new offsets from now on (ie, if
+    # calibrating again)
+    def _save(self):
+        self.audio.output_offset = self.output_offset
+        self.audio.input_offset = self.input_offset
+        config = load_audio_config()
+        config['outputoffset'] = int(round(1000 * self.output_offset))
+        config['inputoffset'] = int(round(1000 * self.input_offset))
+        save_audio_config(config)
+
+    def on_update(self):
+        self.audio.on_update()
+
+        # flashes are timed when they are drawn, so frame timing doesn't count
+        # as input latency
+        now = time.perf_counter()
+        if self.state != 'flash':
+            self.flash_color.a = 0
+        elif now >= self.next_flash:
+            self.beats.append(now)
+            self.next_flash += self.beat_len
+            self.flash_color.a = 1
+        elif self.beats:
+            self.flash_color.a = max(0, 1 - (now - self.beats[-1]) / kFlashTime)
+
+        if self.state == 'start':
+            txt = 'Latency calibration\n\n' \
+                  'Tap the spacebar in time with the flashes, then with the clicks.\n' \
+                  'Press spacebar to begin.'
+        elif self.state == 'flash':
+            txt = 'Tap on each flash\n{} / {}'.format(len(self.taps), kSkipTaps + kNumTaps)
+        elif self.state == 'click':
+            txt = 'Tap on each click\n{} / {}'.format(len(self.taps), kSkipTaps + kNumTaps)
+        else:
+            txt = 'input offset:  {:.0f}ms (+/- {:.0f}ms)\n' \
+                  'output offset: {:.0f}ms (+/- {:.0f}ms)\n\n' \
+                  'Saved to {}\nPress spacebar to calibrate again.'.format(
+                      1000 * self.input_offset, 1000 * self.input_spread,
+                      1000 * self.output_offset, 1000 * self.output_spread, CONFIG_FILE)
+        self.label.text = txt
+
+
+run(MainWidget)
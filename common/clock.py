@@ -9,8 +9,10 @@
 #####################################################################
 
 import time
+import heapq
 import numpy as np
 from .audio import Audio
+from .mixer import generate_into
 
 
 # Simple time keeper object. It starts at 0 and knows how to pause
@@ -136,7 +138,7 @@ class Scheduler(object):
         super(Scheduler, self).__init__()
         self.clock = clock
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandQueue()
 
     def get_time(self) :
         return self.clock.get_time()
@@ -146,22 +148,15 @@ class Scheduler(object):
         return self.tempo_map.time_to_tick(sec)
 
     # add a record for the function to call at the particular tick
-    # keep the list of commands sorted from lowest to hightest tick
-    # make sure tick is the first argument so sorting will work out
-    # properly
+    # the command queue keeps commands ordered from lowest to hightest tick
     def post_at_tick(self, func, tick, arg = None) :
-        now_tick = self.get_tick()
-
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        self.commands.remove(cmd)
 
     # on_update should be called as often as possible.
     # the only trick here is to make sure we remove the command BEFORE
@@ -169,8 +164,8 @@ class Scheduler(object):
     def on_update(self):
         now_tick = self.get_tick()
         while self.commands:
-            if self.commands[0].tick <= now_tick:
-                command = self.commands.pop(0)
+            if self.commands.peek().tick <= now_tick:
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
@@ -186,11 +181,17 @@ class Scheduler(object):
 # AudioScheduler is a Scheduler and Clock built into one class.
 # It is ALSO a Generator. For it to work, it must be inserted into
 # and Audio generator chain.
+# Normally, the generator is asked for audio up to each command's frame, then
+# the command runs. With batch_events = True, and a generator that supports
+# set_event_offset() (ie, Synth), all commands of a buffer run first, with
+# their MIDI messages stamped with their frame offset, and the generator then
+# renders the whole buffer itself in as few calls as it can.
 class AudioScheduler(object):
-    def __init__(self, tempo_map) :
+    def __init__(self, tempo_map, batch_events = False) :
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
-        self.commands = []
+        self.commands = CommandQueue()
+        self.batch_events = batch_events
 
         self.generator = None
         self.cur_frame = 0
@@ -200,6 +201,13 @@ class AudioScheduler(object):
 
     def generate(self, num_frames, num_channels) :
         output = np.empty(num_channels * num_frames, dtype = np.float32)
+        self.generate_into(output, num_frames, num_channels)
+        return output, True
+
+    def generate_into(self, output, num_frames, num_channels) :
+        if self.batch_events and hasattr(self.generator, 'set_event_offset'):
+            return self._generate_batched(output, num_frames, num_channels)
+
         o_idx = 0
 
         # the current period of time goes from self.cur_frame to end_frame
@@ -208,32 +216,56 @@ class AudioScheduler(object):
         # advance time and fire off commands for this time frame
         while self.commands:
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
+            cmd_tick = self.commands.peek().tick
             cmd_time = self.tempo_map.tick_to_time(cmd_tick)
             cmd_frame = int(cmd_time * Audio.sample_rate)
 
             if cmd_frame < end_frame:
                 o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
-                command = self.commands.pop(0)
+                command = self.commands.pop()
                 command.execute()
             else:
                 break
 
         self._generate_until(end_frame, num_channels, output, o_idx)
 
-        return output, True
+        return True
+
+    # run all commands that fall in this buffer, then have the generator render
+    # the buffer with their MIDI messages at the right frames
+    def _generate_batched(self, output, num_frames, num_channels) :
+        start_frame = self.cur_frame
+        end_frame = start_frame + num_frames
+
+        while self.commands:
+            cmd_tick = self.commands.peek().tick
+            cmd_time = self.tempo_map.tick_to_time(cmd_tick)
+            cmd_frame = int(cmd_time * Audio.sample_rate)
+
+            if cmd_frame < end_frame:
+                # while the command runs, time is the command's frame, as usual
+                self.cur_frame = max(cmd_frame, self.cur_frame)
+                self.generator.set_event_offset(self.cur_frame - start_frame)
+                command = self.commands.pop()
+                command.execute()
+            else:
+                break
 
-    # generate audio from self.cur_frame to to_frame
+        self.generator.set_event_offset(None)
+        generate_into(self.generator, output, num_frames, num_channels)
+        self.cur_frame = end_frame
+        return True
+
+    # generate audio from self.cur_frame to to_frame, directly into output
     def _generate_until(self, to_frame, num_channels, output, o_idx) :
         num_frames = to_frame - self.cur_frame
         if num_frames > 0:
+            next_o_idx = o_idx+(num_channels * num_frames)
             if self.generator:
-                data, cont = self.generator.generate(num_frames, num_channels)
+                generate_into(self.generator, output[o_idx : next_o_idx], num_frames, num_channels)
             else:
-                data = np.zeros(num_channels * num_frames, dtype=np.float32)
+                output[o_idx : next_o_idx] = 0
 
-            next_o_idx = o_idx+(num_channels * num_frames)
-            output[o_idx : next_o_idx] = data
             self.cur_frame += num_frames
             return next_o_idx
         else:
@@ -248,20 +280,14 @@ class AudioScheduler(object):
 
     # add a record for the function to call at the particular tick
     def post_at_tick(self, func, tick, arg = None) :
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
-        # create a command to hold the function/arg and sort by tick
+        # create a command to hold the function/arg, queued by tick
         cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
+        self.commands.push(cmd)
         return cmd
 
     # attempt a removal. Does nothing if cmd is not found
     def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
+        self.commands.remove(cmd)
 
     def now_str(self):
         time = self.get_time()
@@ -271,6 +297,62 @@ class AudioScheduler(object):
         return txt
 
 
+# Priority queue of Commands, lowest tick first, for Scheduler and
+# AudioScheduler. It's a binary heap: push() and pop() are O(log n), peek() is
+# O(1). Commands with the same tick come out in the order they were pushed.
+# remove() just marks the command as no longer queued (O(1)). Removed commands
+# are skipped when they reach the front, and the heap is rebuilt if they
+# start to pile up.
+class CommandQueue(object):
+    def __init__(self):
+        super(CommandQueue, self).__init__()
+        self.heap = []        # entries are (tick, sequence number, cmd)
+        self.num_pushed = 0
+        self.num_queued = 0
+
+    def push(self, cmd):
+        heapq.heappush(self.heap, (cmd.tick, self.num_pushed, cmd))
+        cmd.queue = self
+        self.num_pushed += 1
+        self.num_queued += 1
+
+    # next command to run (without removing it), or None if empty
+    def peek(self):
+        self._skip_removed()
+        return self.heap[0][2] if self.heap else None
+
+    # remove and return the next command to run
+    def pop(self):
+        self._skip_removed()
+        cmd = heapq.heappop(self.heap)[2]
+        cmd.queue = None
+        self.num_queued -= 1
+        return cmd
+
+    # does nothing if cmd is None or not in this queue
+    def remove(self, cmd):
+        if cmd is None or cmd.queue is not self:
+            return
+        cmd.queue = None
+        self.num_queued -= 1
+
+        # too much garbage - rebuild the heap with just the queued commands
+        if len(self.heap) > 2 * self.num_queued + 64:
+            self.heap = [e for e in self.heap if e[2].queue is self]
+            heapq.heapify(self.heap)
+
+    def _skip_removed(self):
+        heap = self.heap
+        while heap and heap[0][2].queue is not self:
+            heapq.heappop(heap)
+
+    def __len__(self):
+        return self.num_queued
+
+    def __repr__(self):
+        return repr([e[2] for e in sorted(self.heap) if e[2].queue is self])
+
+
 class Command(object):
     def __init__(self, tick, func, arg):
         super(Command, self).__init__()
@@ -278,6 +360,7 @@ class Command(object):
         self.func = func
         self.arg = arg
         self.did_it = False
+        self.queue = None  # CommandQueue this command is waiting in
 
     def execute(self):
         # ensure that execute only gets called once.
@@ -0,0 +1,30 @@
+import numpy as np
+
+# Real FFTs into existing arrays, for analysis that runs every buffer or hop
+# and shouldn't allocate.
+#
+# np.fft can write into an existing array since numpy 2.0. On older versions,
+# each transform allocates its result, which is then copied into out.
+try:
+    np.fft.rfft(np.zeros(4), out=np.empty(3, dtype=np.complex128))
+    g_fft_out = True
+except TypeError:
+    g_fft_out = False
+
+
+# spectrum of real signal x into out (len(x) // 2 + 1 complex bins)
+def rfft_into(x, out):
+    if g_fft_out:
+        np.fft.rfft(x, out=out)
+    else:
+        out[:] = np.fft.rfft(x)
+    return out
+
+
+# real signal of length n from spectrum spec into out
+def irfft_into(spec, n, out):
+    if g_fft_out:
+        np.fft.irfft(spec, n, out=out)
+    else:
+        out[:] = np.fft.irfft(spec, n)
+    return out
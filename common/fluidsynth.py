@@ -168,6 +168,16 @@ fluid_synth_write_s16 = cfunc('fluid_synth_write_s16', c_void_p,
                               ('roff', c_int, 1),
                               ('rincr', c_int, 1))
 
+fluid_synth_write_float = cfunc('fluid_synth_write_float', c_int,
+                              ('synth', c_void_p, 1),
+                              ('len', c_int, 1),
+                              ('lbuf', c_void_p, 1),
+                              ('loff', c_int, 1),
+                              ('lincr', c_int, 1),
+                              ('rbuf', c_void_p, 1),
+                              ('roff', c_int, 1),
+                              ('rincr', c_int, 1))
+
 class fluid_synth_channel_info_t(Structure):
     _fields_ = [
         ('assigned', c_int),
@@ -397,6 +407,19 @@ def fluid_synth_write_s16_stereo(synth, len):
     fluid_synth_write_s16(synth, len, buf, 0, 2, buf, 1, 2)
     return numpy.fromstring(buf[:], dtype=numpy.int16)
 
+def fluid_synth_write_float_stereo(synth, len, buf):
+    """Write generated samples into buf in interleaved stereo float format
+
+    buf must be a contiguous Numpy float32 array of at least 2 * len
+    samples. Samples are written in place; nothing is allocated.
+
+    """
+    import numpy
+    if buf.dtype != numpy.float32 or not buf.flags.c_contiguous or buf.size < 2 * len:
+        raise ValueError("buf must be a contiguous float32 array of 2 * len samples")
+    ptr = buf.ctypes.data
+    fluid_synth_write_float(synth, len, ptr, 0, 2, ptr, 1, 2)
+
 
 # Object-oriented interface, simplifies access to functions
 
@@ -644,6 +667,13 @@ class Synth:
 
         """
         return fluid_synth_write_s16_stereo(self.synth, len)
+    def write_samples(self, buf, len):
+        """Generate audio samples directly into a NumPy float32 array
+
+        buf receives 2 * len interleaved stereo samples in [-1, 1].
+
+        """
+        fluid_synth_write_float_stereo(self.synth, len, buf)
 
 class Sequencer:
     def __init__(self, time_scale=1000, use_system_timer=True):
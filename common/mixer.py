@@ -9,13 +9,130 @@
 #####################################################################
 
 import numpy as np
+import time
+
+
+# Generators may optionally support the method
+# generate_into(out, num_frames, num_channels),
+# which writes exactly num_frames * num_channels samples into out (a float32
+# numpy array of that length) and returns the continue flag. This lets the
+# audio chain run without allocating a new array for every buffer.
+# This helper calls generate_into() if the generator supports it, and otherwise
+# falls back to generate(), copying (and zero-padding) its output into out.
+def generate_into(gen, out, num_frames, num_channels) :
+    if hasattr(gen, 'generate_into'):
+        return gen.generate_into(out, num_frames, num_channels)
+
+    (signal, keep_going) = gen.generate(num_frames, num_channels)
+    n = len(signal)
+    out[:n] = signal
+    out[n:] = 0
+    return keep_going
+
+
+# Gain with click-free changes: instead of jumping, set() ramps from the
+# current gain to the new one over ramp_time seconds. apply() multiplies a
+# buffer in place, sample by sample while ramping, and by a single number
+# otherwise. Ramp shapes come from a cached table, so a ramp costs about the
+# same as a constant gain.
+#   shape - 'linear', or 'exp' (fast at first, then easing into the target,
+#           which sounds more even for fades)
+class GainRamp(object):
+    def __init__(self, gain = 1.0):
+        super(GainRamp, self).__init__()
+        self.gain = gain     # gain of the next sample
+        self.target = gain
+        self.start = gain
+        self.table = None    # ramp shape, from 0 to 1. None when not ramping
+        self.pos = 0
+        self.gains = np.empty(0, dtype=np.float32)
+
+    def set(self, gain, ramp_time = 0., shape = 'linear'):
+        num_frames = int(ramp_time * _sample_rate())
+        if num_frames < 1 or gain == self.gain:
+            self.gain = self.target = gain
+            self.table = None
+        else:
+            self.start = self.gain
+            self.target = gain
+            self.table = get_ramp_table(shape, num_frames)
+            self.pos = 0
+
+    def get(self):
+        return self.target
+
+    def is_ramping(self):
+        return self.table is not None
+
+    # multiply output (num_frames of num_channels interleaved) by the gain
+    def apply(self, output, num_frames, num_channels):
+        if self.table is None:
+            if self.gain != 1.0:
+                output *= self.gain
+            return
+
+        n = min(num_frames, len(self.table) - self.pos)
+        if len(self.gains) < n:
+            self.gains = np.empty(num_frames, dtype=np.float32)
+
+        # gains = start + (target - start) * table
+        gains = self.gains[:n]
+        np.multiply(self.table[self.pos : self.pos + n], self.target - self.start, out=gains)
+        gains += self.start
+
+        # one channel at a time: broadcasting gains across channels would make
+        # numpy allocate a temporary buffer
+        ramped = output[:n * num_channels]
+        for c in range(num_channels):
+            ch = ramped[c::num_channels]
+            np.multiply(ch, gains, out=ch)
+
+        self.pos += n
+        self.gain = float(gains[-1])
+        if self.pos == len(self.table):
+            self.gain = self.target
+            self.table = None
+            if n < num_frames and self.gain != 1.0:
+                output[n * num_channels:] *= self.gain
+
+
+# ramp tables already made, by (shape, num_frames)
+g_ramp_tables = {}
+
+# return a ramp of num_frames values rising to 1 (float32). The value for the
+# frame before the ramp is 0.
+def get_ramp_table(shape, num_frames):
+    key = (shape, num_frames)
+    if key not in g_ramp_tables:
+        x = np.arange(1, num_frames + 1) / float(num_frames)
+        if shape == 'linear':
+            table = x
+        elif shape == 'exp':
+            k = 5.0
+            table = (1 - np.exp(-k * x)) / (1 - np.exp(-k))
+        else:
+            raise ValueError('unknown ramp shape: ' + shape)
+        g_ramp_tables[key] = table.astype(np.float32)
+    return g_ramp_tables[key]
+
+# audio.py imports this module, so Audio can't be imported at the top
+def _sample_rate():
+    from .audio import Audio
+    return Audio.sample_rate
 
 
 class Mixer(object):
     def __init__(self):
         super(Mixer, self).__init__()
         self.generators = []
-        self.gain = 0.25;
+        self.gain = GainRamp(0.25)
+
+        # scratch buffer for generators after the first. Grows as needed, and
+        # is reused for every buffer after that.
+        self.scratch = np.empty(0, dtype=np.float32)
+
+        # optional PerfMonitor, to time each generator
+        self.monitor = None
 
     def add(self, gen) :
         if gen not in self.generators:
@@ -23,34 +140,73 @@ class Mixer(object):
 
     def remove(self, gen) :
         self.generators.remove(gen)
+        if self.monitor:
+            self.monitor.forget(gen)
 
-    def set_gain(self, gain) :
-        self.gain = np.clip(gain, 0, 1)
+    # ramp_time > 0 fades to the new gain over that many seconds
+    def set_gain(self, gain, ramp_time = 0., shape = 'linear') :
+        self.gain.set(float(np.clip(gain, 0, 1)), ramp_time, shape)
 
     def get_gain(self) :
-        return self.gain
+        return self.gain.get()
+
+    def set_monitor(self, monitor) :
+        self.monitor = monitor
 
     def get_num_generators(self) :
         return len(self.generators)
 
     def generate(self, num_frames, num_channels) :
-        output = np.zeros(num_frames * num_channels)
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
 
-        # this calls generate() for each generator. generator must return:
-        # (signal, keep_going). If keep_going is True, it means the generator
-        # has more to generate. False means generator is done and will be
-        # removed from the list. signal must be a numpay array of length
+    def generate_into(self, output, num_frames, num_channels) :
+        size = num_frames * num_channels
+        if len(self.scratch) < size:
+            self.scratch = np.empty(size, dtype=np.float32)
+        scratch = self.scratch[:size]
+
+        # this calls generate_into() (or generate()) for each generator. The
+        # first generator writes straight into output, the rest are accumulated
+        # in place. If keep_going is True, it means the generator has more to
+        # generate. False means generator is done and will be removed from the
+        # list. generate() must return a numpy array of length
         # num_frames * num_channels (or less)
+        filled = False
         kill_list = []
+        monitor = self.monitor
         for g in self.generators:
-            (signal, keep_going) = g.generate(num_frames, num_channels)
-            output += signal
+            if monitor:
+                t_start = time.perf_counter()
+            if hasattr(g, 'generate_into'):
+                if filled:
+                    keep_going = g.generate_into(scratch, num_frames, num_channels)
+                    output += scratch
+                else:
+                    keep_going = g.generate_into(output, num_frames, num_channels)
+            else:
+                (signal, keep_going) = g.generate(num_frames, num_channels)
+                n = len(signal)
+                if filled:
+                    output[:n] += signal
+                else:
+                    output[:n] = signal
+                    output[n:] = 0
+            if monitor:
+                monitor.record(g, time.perf_counter() - t_start)
+            filled = True
             if not keep_going:
                 kill_list.append(g)
 
+        if not filled:
+            output.fill(0)
+
         # remove generators that are done
         for g in kill_list:
             self.generators.remove(g)
+            if monitor:
+                monitor.forget(g)
 
-        output *= self.gain
-        return (output, True)
+        self.gain.apply(output, num_frames, num_channels)
+        return True
@@ -10,6 +10,7 @@
 
 import numpy as np
 from .audio import Audio
+from .wavetable import get_wavetable, wavetable_lookup, kTableSize
 
 # Twelevth root of 2
 kTRT = pow(2.0, 1.0/12.0)
@@ -25,7 +26,12 @@ class NoteGenerator(object):
     saw    = (1., 1/2., 1/3., 1/4., 1/5., 1/6., 1/7., 1/8., 1/9.)
     tri    = (1., 0, -1/9., 0, 1/25., 0, -1/49.)
 
-    def __init__(self, pitch, gain, duration, attack = 0.01, harmonics = (1.0,) ):
+    # wavetable = True plays the harmonics from a precomputed band-limited
+    # wavetable (see wavetable.py) instead of summing sines every buffer. Its
+    # cost doesn't depend on the number of harmonics: with 512-frame buffers,
+    # it is about 5x faster than summing sines for saw, and 3x for sine (see
+    # benchmarks/bench_audio.py).
+    def __init__(self, pitch, gain, duration, attack = 0.01, harmonics = (1.0,), wavetable = False):
         super(NoteGenerator, self).__init__()
 
         self.freq = midi_to_frequency(pitch)
@@ -35,7 +41,26 @@ class NoteGenerator(object):
         self.env = Envelope(attack, duration - attack, 2, 2)
         self.harmonics = harmonics
 
+        # wavetable mode uses a phase accumulator (in table samples) instead of
+        # frame, and renders with generate_into() into reused float32 buffers.
+        # The note keeps its own copy of the table with the gain applied, as
+        # the value at each sample and the slope to the next one, so a lookup
+        # is just table + frac * slope.
+        self.table = None
+        if wavetable:
+            table = get_wavetable(harmonics, self.freq) * np.float32(self.gain)
+            self.table = table[:-1]
+            self.slope = np.diff(table)
+        self.phase = 0.0
+        self.incr = self.freq * kTableSize / Audio.sample_rate   # table samples per frame
+        self.bufs = None
+
     def generate(self, num_frames, num_channels) :
+        if self.table is not None:
+            output = np.empty(num_frames * num_channels, dtype=np.float32)
+            continue_flag = self.generate_into(output, num_frames, num_channels)
+            return (output, continue_flag)
+
         # normal case:
         end_frame = self.frame + num_frames
         continue_flag = True
@@ -44,12 +69,14 @@ class NoteGenerator(object):
         if end_frame > self.duration * Audio.sample_rate:
             continue_flag = False
 
+        env = self.env.generate(num_frames)                # envelope
+
         frames = np.arange(self.frame, end_frame)          # frame range for this buffer
         factor = (2.0 * np.pi) * self.freq / Audio.sample_rate   # frequency / time conversion
-        env = self.env.generate(num_frames)                # envelope
+        signal = sin_with_harmonics( factor * frames,  self.harmonics)
 
         # final output with gain and envelope
-        output = self.gain * env * sin_with_harmonics( factor * frames,  self.harmonics)
+        output = self.gain * env * signal
 
         self.frame += num_frames
 
@@ -62,6 +89,48 @@ class NoteGenerator(object):
 
         return (output, continue_flag)
 
+    def generate_into(self, output, num_frames, num_channels) :
+        if self.table is None:
+            (signal, continue_flag) = self.generate(num_frames, num_channels)
+            output[:] = signal
+            return continue_flag
+
+        end_frame = self.frame + num_frames
+        continue_flag = end_frame <= self.duration * Audio.sample_rate
+
+        if self.bufs is None or len(self.bufs[0]) < num_frames:
+            self.bufs = [np.empty(num_frames, dtype=np.float32) for i in range(4)] + \
+                        [np.empty(num_frames, dtype=np.intp)]
+            # table position of each frame, from the first frame of a buffer
+            self.steps = (np.arange(num_frames) * self.incr).astype(np.float32)
+        pos, frac, signal, env, idx = [b[:num_frames] for b in self.bufs]
+
+        # table position of each frame. Positions run past the end of the
+        # table; the index is wrapped instead (kTableSize is a power of 2).
+        np.add(self.steps[:num_frames], self.phase, out=pos)
+        self.phase = (self.phase + self.incr * num_frames) % kTableSize
+
+        # interpolated lookup: table + frac * slope. (np.take's mode = 'clip'
+        # is only there so that it writes straight into out.)
+        np.floor(pos, out=signal)
+        np.subtract(pos, signal, out=frac)
+        np.copyto(idx, signal, casting='unsafe')
+        np.bitwise_and(idx, kTableSize - 1, out=idx)
+        np.take(self.table, idx, out=signal, mode='clip')
+        np.take(self.slope, idx, out=pos, mode='clip')
+        pos *= frac
+        signal += pos
+
+        # final output with envelope (the gain is in the table)
+        self.env.generate_into(env, num_frames)
+        self.frame = end_frame
+
+        out2 = output.reshape(num_frames, num_channels)
+        np.multiply(signal, env, out=out2[:, 0])
+        for c in range(1, num_channels):
+            out2[:, c] = out2[:, 0]
+        return continue_flag
+
 
 def sin_with_harmonics(time, harmonics) :
     # create fundamental frequency
@@ -87,6 +156,8 @@ class Envelope(object):
         self.n2 = n2
 
         self.frame = 0
+        self.ramp = None         # for generate_into(): frames, and frames / decay_f
+        self.decay_ramp = None
 
     def generate(self, num_frames) :
         # set up correct frame ranges:
@@ -112,3 +183,178 @@ class Envelope(object):
         # advance frame counter
         self.frame = end_frame
         return env
+
+    # same envelope as generate(), written into output (a float32 array)
+    # without allocating
+    def generate_into(self, output, num_frames) :
+        if self.ramp is None or len(self.ramp) < num_frames:
+            self.ramp = np.arange(num_frames, dtype=np.float32)
+            self.decay_ramp = self.ramp / np.float32(max(self.decay_f, 1))
+        end_frame = self.frame + num_frames
+        boundary = min(max(self.attack_f - self.frame, 0), num_frames)
+
+        # all done
+        if self.frame >= self.attack_f + self.decay_f:
+            output[:num_frames] = 0
+            self.frame = end_frame
+            return output
+
+        # attack part: (frame / attack_f) ^ (1/n1)
+        attack = output[:boundary]
+        if boundary:
+            np.add(self.ramp[:boundary], self.frame, out=attack)
+            attack *= 1.0 / self.attack_f
+            _root(attack, self.n1)
+
+        # decay part: 1 - ((frame - attack_f) / decay_f) ^ (1/n2), clamped to 0
+        decay = output[boundary:num_frames]
+        np.add(self.decay_ramp[boundary:num_frames],
+               float(self.frame - self.attack_f) / max(self.decay_f, 1), out=decay)
+        if end_frame > self.attack_f + self.decay_f:
+            np.minimum(decay, 1, out=decay)
+        _root(decay, self.n2)
+        np.subtract(1, decay, out=decay)
+
+        self.frame = end_frame
+        return output
+
+# x = x ^ (1/n), in place
+def _root(x, n):
+    if n == 2:
+        np.sqrt(x, out=x)
+    else:
+        np.power(x, 1.0 / n, out=x)
+
+
+# Plays many notes at once, like a set of NoteGenerators, but renders all
+# active notes and all their harmonics together as one 2-D (notes x frames)
+# phase matrix. Each note keeps a phase accumulator (in cycles, wrapped to
+# [0, 1)) instead of a running frame count, so the math stays precise no
+# matter how long the bank has been playing.
+# With wavetable = True, notes are read from band-limited wavetables
+# (see wavetable.py) instead of computing the harmonics with np.sin.
+# Add it to a Mixer once and call note_on() for each note.
+class OscillatorBank(object):
+    def __init__(self, max_voices = 64, max_harmonics = 9, wavetable = False):
+        super(OscillatorBank, self).__init__()
+        self.max_voices = max_voices
+        self.max_harmonics = max_harmonics
+        self.wavetable = wavetable
+
+        # per-voice state
+        self.active   = np.zeros(max_voices, dtype=bool)
+        self.phase    = np.zeros(max_voices)
+        self.incr     = np.zeros(max_voices)  # cycles per frame
+        self.gain     = np.zeros(max_voices)
+        self.frame    = np.zeros(max_voices)  # frames since note_on (for envelope)
+        self.end_f    = np.zeros(max_voices)
+        self.attack_f = np.ones(max_voices)
+        self.decay_f  = np.ones(max_voices)
+        self.weights  = np.zeros((max_voices, max_harmonics))
+        self.order    = np.zeros(max_voices, dtype=np.int64)
+        if wavetable:
+            self.tables = np.zeros((max_voices, kTableSize + 1), dtype=np.float32)
+
+        self.harmonic_nums = np.arange(1, max_harmonics + 1, dtype=np.float64)
+        self.num_notes = 0
+        self.ramp = np.arange(0, dtype=np.float64)
+
+    # start a note, same arguments as NoteGenerator. Returns the voice index.
+    # If all voices are busy, the oldest note is replaced.
+    def note_on(self, pitch, gain, duration, attack = 0.01, harmonics = NoteGenerator.sine):
+        assert(len(harmonics) <= self.max_harmonics)
+
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            v = free[0]
+        else:
+            v = np.argmin(self.order)
+
+        self.active[v] = True
+        self.phase[v] = 0
+        self.incr[v] = midi_to_frequency(pitch) / Audio.sample_rate
+        self.gain[v] = gain
+        self.frame[v] = 0
+        self.end_f[v] = duration * Audio.sample_rate
+        self.attack_f[v] = max(round(attack * Audio.sample_rate), 1)
+        self.decay_f[v] = max(round((duration - attack) * Audio.sample_rate), 1)
+        self.weights[v] = 0
+        self.weights[v, :len(harmonics)] = harmonics
+        if self.wavetable:
+            self.tables[v] = get_wavetable(harmonics, midi_to_frequency(pitch))
+        self.order[v] = self.num_notes
+        self.num_notes += 1
+        return v
+
+    # stop a note right away
+    def note_off(self, voice):
+        self.active[voice] = False
+
+    def get_num_active(self):
+        return np.count_nonzero(self.active)
+
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
+
+    def generate_into(self, output, num_frames, num_channels) :
+        voices = np.flatnonzero(self.active)
+        if len(voices) == 0:
+            output.fill(0)
+            return True
+
+        if len(self.ramp) < num_frames:
+            self.ramp = np.arange(num_frames, dtype=np.float64)
+        ramp = self.ramp[:num_frames]
+
+        # phase (in cycles) of each note at each frame: (notes x frames)
+        phase = self.phase[voices, np.newaxis] + self.incr[voices, np.newaxis] * ramp
+
+        if self.wavetable:
+            signal = self._lookup_tables(voices, phase)
+        else:
+            signal = self._sum_harmonics(voices, phase)
+
+        signal *= self._envelope(voices, ramp)
+        signal *= self.gain[voices, np.newaxis]
+        mono = signal.sum(axis=0)
+
+        # copy to all channels
+        output.reshape(num_frames, num_channels)[:] = mono[:, np.newaxis]
+
+        # advance phase accumulators (wrapped) and envelope frames
+        self.phase[voices] = (self.phase[voices] + self.incr[voices] * num_frames) % 1.0
+        self.frame[voices] += num_frames
+
+        # notes are done once their duration has passed
+        done = voices[self.frame[voices] >= self.end_f[voices]]
+        self.active[done] = False
+
+        return True
+
+    def _sum_harmonics(self, voices, phase):
+        # only compute harmonics that some active note uses
+        weights = self.weights[voices]
+        used = np.flatnonzero(weights.any(axis=0))
+        harm = self.harmonic_nums[used]
+
+        # all harmonics of all notes in one np.sin call: (notes x harmonics x frames)
+        waves = np.sin((2.0 * np.pi) * phase[:, np.newaxis, :] * harm[np.newaxis, :, np.newaxis])
+        return np.einsum('nh,nhf->nf', weights[:, used], waves)
+
+    def _lookup_tables(self, voices, phase):
+        # index each note's row of the flattened table array
+        phase %= 1.0
+        rows = (voices * (kTableSize + 1))[:, np.newaxis]
+        return wavetable_lookup(self.tables.reshape(-1), phase + rows / float(kTableSize))
+
+    # Envelope (n1 = n2 = 2) for each note: (notes x frames)
+    def _envelope(self, voices, ramp):
+        frames = self.frame[voices, np.newaxis] + ramp
+        attack_f = self.attack_f[voices, np.newaxis]
+        decay_f = self.decay_f[voices, np.newaxis]
+
+        attack = np.sqrt(np.minimum(frames / attack_f, 1.0))
+        decay = 1.0 - np.sqrt(np.clip((frames - attack_f) / decay_f, 0, 1))
+        return np.where(frames < attack_f, attack, decay)
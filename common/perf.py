@@ -0,0 +1,154 @@
+import time
+
+# Histogram bins are powers of two in microseconds: bin i counts times in
+# [2^(i+3), 2^(i+4)) us, so bin 0 is everything under 16us and the last bin is
+# everything over ~130ms. The bin is found with int.bit_length(), which is much
+# cheaper than searching a list of edges.
+kNumBins = 14
+kBinOffset = 4
+
+
+def time_bin(dt):
+    b = int(dt * 1000000).bit_length() - kBinOffset
+    return min(max(b, 0), kNumBins - 1)
+
+# upper edge of bin b, in milliseconds
+def bin_edge(b):
+    return (1 << (b + kBinOffset)) / 1000.
+
+
+# Render time statistics for one node (a generator, or the whole audio buffer)
+class PerfStats(object):
+    def __init__(self, name):
+        super(PerfStats, self).__init__()
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.hist = [0] * kNumBins
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+
+    def add(self, dt):
+        self.hist[time_bin(dt)] += 1
+        self.count += 1
+        self.total += dt
+        self.last = dt
+        if dt > self.max:
+            self.max = dt
+
+    # average time in milliseconds
+    def get_avg(self):
+        return 1000 * self.total / self.count if self.count else 0.
+
+    # approximate percentile (0-100) in milliseconds: the upper edge of the
+    # histogram bin that contains it (but no more than the max)
+    def get_percentile(self, pct):
+        target = self.count * pct / 100.
+        running = 0
+        for b, n in enumerate(self.hist):
+            running += n
+            if n and running >= target:
+                return min(bin_edge(b), 1000 * self.max)
+        return 0.
+
+
+# Collects real-time performance data from the audio engine:
+# - render time histograms per generator (from Mixer) and per audio buffer
+#   (from Audio)
+# - deadline misses: buffers that took longer to generate than they last
+# - starvation: times the output stream ran dry before it was refilled
+#
+# Usage:
+#   monitor = PerfMonitor()
+#   audio.set_monitor(monitor)
+#   mixer.set_monitor(monitor)
+#
+# Data is recorded on the audio thread and can be read from the main thread
+# (ie, get_txt() for a label). Set the monitor to None to turn it off. When off,
+# the only cost is one attribute test per generator per buffer.
+class PerfMonitor(object):
+    def __init__(self):
+        super(PerfMonitor, self).__init__()
+        self.nodes = {}
+        self.names = {}
+        self.buffer = PerfStats('buffer')
+        self.deadline_misses = 0
+        self.starved = 0
+        self.last_miss_time = None
+        self.last_starved_time = None
+
+    # give a generator a readable name in reports. Otherwise, its class name
+    # is used.
+    def set_name(self, node, name):
+        self.names[id(node)] = name
+        if id(node) in self.nodes:
+            self.nodes[id(node)].name = name
+
+    # record dt seconds spent rendering node
+    def record(self, node, dt):
+        stats = self.nodes.get(id(node))
+        if stats is None:
+            stats = PerfStats(self.names.get(id(node), type(node).__name__))
+            self.nodes[id(node)] = stats
+        stats.add(dt)
+
+    # record one audio buffer of num_frames that took dt seconds to generate.
+    # deadline is the time available, which is normally the duration of the
+    # buffer.
+    def record_buffer(self, num_frames, dt, deadline):
+        self.buffer.add(dt)
+        if dt > deadline:
+            self.deadline_misses += 1
+            self.last_miss_time = time.time()
+
+    # record that the output stream ran out of data
+    def record_starved(self):
+        self.starved += 1
+        self.last_starved_time = time.time()
+
+    def reset(self):
+        for stats in self.nodes.values():
+            stats.reset()
+        self.buffer.reset()
+        self.deadline_misses = 0
+        self.starved = 0
+        self.last_miss_time = None
+        self.last_starved_time = None
+
+    # drop the stats and name of a generator that is done. Stats are kept by
+    # id(), which Python reuses for new objects once this one is gone.
+    def forget(self, node):
+        self.nodes.pop(id(node), None)
+        self.names.pop(id(node), None)
+
+    # forget generators that are no longer in use
+    def clear_nodes(self):
+        self.nodes = {}
+
+    # return all stats as a dictionary, with times in milliseconds
+    def get_stats(self):
+        def summary(s):
+            return {'name': s.name, 'count': s.count, 'avg': s.get_avg(),
+                    'p95': s.get_percentile(95), 'max': 1000 * s.max,
+                    'last': 1000 * s.last, 'hist': list(s.hist)}
+
+        return {'buffer': summary(self.buffer),
+                'nodes': [summary(s) for s in list(self.nodes.values())],
+                'deadline_misses': self.deadline_misses,
+                'starved': self.starved}
+
+    # text summary, suitable for a label. Shows the num_nodes most expensive
+    # generators by total render time.
+    def get_txt(self, num_nodes = 5):
+        b = self.buffer
+        txt = 'audio: {:.2f}ms avg, {:.2f}ms p95, {:.2f}ms max\n'.format(
+            b.get_avg(), b.get_percentile(95), 1000 * b.max)
+        txt += 'deadline misses: {}  starved: {}\n'.format(self.deadline_misses, self.starved)
+
+        nodes = sorted(list(self.nodes.values()), key=lambda s: s.total, reverse=True)
+        for s in nodes[:num_nodes]:
+            txt += '  {}: {:.2f}ms avg, {:.2f}ms max\n'.format(s.name, s.get_avg(), 1000 * s.max)
+        return txt
@@ -0,0 +1,87 @@
+import numpy as np
+import time
+from .audio import Audio
+from .mixer import generate_into
+from .writer import WaveWriter
+
+# Offline rendering: runs any generator (Mixer, AudioScheduler, Synth, ...) as
+# fast as the CPU allows, with no audio device. The generator is called one
+# block at a time, exactly like Audio would call it, so an AudioScheduler
+# fires its commands at the same frames it would live.
+# Once the generator is done (returns False as its continue flag), the rest of
+# the output is silence, which is what you would hear with Audio.
+class OfflineRenderer(object):
+    def __init__(self, generator, num_channels = 2, block_size = 512):
+        super(OfflineRenderer, self).__init__()
+        self.generator = generator
+        self.num_channels = num_channels
+        self.block_size = block_size
+        self.buffer = np.empty(block_size * num_channels, dtype=np.float32)
+        self.frames_rendered = 0
+        self.done = False
+
+    # render num_frames, calling func(data) with each block. data is only
+    # valid during the call.
+    def process(self, num_frames, func):
+        remaining = num_frames
+        while remaining > 0:
+            n = min(self.block_size, remaining)
+            data = self.buffer[:n * self.num_channels]
+
+            if self.done:
+                data.fill(0)
+            elif not generate_into(self.generator, data, n, self.num_channels):
+                self.done = True
+
+            func(data)
+            remaining -= n
+            self.frames_rendered += n
+
+    # render num_frames and return them as one interleaved float32 array
+    def render(self, num_frames):
+        output = np.empty(num_frames * self.num_channels, dtype=np.float32)
+        pos = [0]
+
+        def copy(data):
+            output[pos[0] : pos[0] + len(data)] = data
+            pos[0] += len(data)
+
+        self.process(num_frames, copy)
+        return output
+
+    # render num_frames into a .wav or .npy file, writing as we go.
+    # returns the realtime factor (seconds of audio per second of rendering).
+    def render_to_file(self, filepath, num_frames):
+        t_start = time.time()
+
+        if filepath.endswith('.npy'):
+            # the file is mapped and filled in block by block
+            output = np.lib.format.open_memmap(filepath, mode='w+', dtype=np.float32,
+                                               shape=(num_frames * self.num_channels,))
+            pos = [0]
+
+            def write(data):
+                output[pos[0] : pos[0] + len(data)] = data
+                pos[0] += len(data)
+
+            self.process(num_frames, write)
+            output.flush()
+            del output
+
+        else:
+            writer = WaveWriter(filepath, self.num_channels)
+            try:
+                self.process(num_frames, writer.write)
+            finally:
+                writer.close()
+
+        dt = max(time.time() - t_start, 1e-9)
+        return (num_frames / float(Audio.sample_rate)) / dt
+
+
+# render duration seconds of generator into filepath (.wav or .npy).
+# returns the realtime factor.
+def render_to_file(generator, filepath, duration, num_channels = 2, block_size = 512):
+    num_frames = int(round(duration * Audio.sample_rate))
+    renderer = OfflineRenderer(generator, num_channels, block_size)
+    return renderer.render_to_file(filepath, num_frames)
@@ -0,0 +1,335 @@
+import numpy as np
+from .audio import Audio
+from .mixer import generate_into
+
+# Streaming resampler: plays another generator back at a different speed
+# (changing pitch and tempo together). Unlike resampling each buffer on its own,
+# the fractional read position and the last few input frames are kept from one
+# buffer to the next, so there are no discontinuities at buffer boundaries.
+#
+# mode is one of:
+#   'linear' - linear interpolation between neighboring frames. Cheap.
+#   'sinc'   - windowed-sinc interpolation from a polyphase table of
+#              kSincTaps taps. When speeding up, the cutoff is lowered to
+#              the new Nyquist frequency, so there is much less aliasing.
+#
+# Speed changes ramp linearly over ramp_time seconds, instead of jumping.
+# Work buffers are kept and reused, so no memory is allocated per buffer
+# (once buffer size and speed settle). At speed 1 (and not ramping), the input
+# is passed straight through.
+class Resampler(object):
+    def __init__(self, generator, speed = 1.0, mode = 'linear', ramp_time = 0.02):
+        super(Resampler, self).__init__()
+        assert(mode in ('linear', 'sinc'))
+        self.generator = generator
+        self.mode = mode
+        self.ramp_time = ramp_time
+
+        self.speed = float(speed)    # speed of the next output frame
+        self.target = float(speed)   # speed we are ramping to
+        self.step = 0.               # speed change per frame while ramping
+
+        # frames of history needed on each side of the read position
+        self.half_taps = 1 if mode == 'linear' else kSincTaps // 2
+        self.table = None
+        self.cutoff = None
+
+        self.num_channels = 0
+        self.reset()
+
+    # start over from an empty history. Call this if the input generator is
+    # moved (ie, reset) so that old input is not blended into new.
+    def reset(self):
+        self.history = np.empty(0, dtype=np.float32)
+        self.num_channels = 0
+        self.num_buffered = 0
+        self.pos = 0.
+        self.end_frame = None
+        self.bypass = False
+        self.tail = None
+
+    # ramp_time None means use the default ramp time given to the constructor.
+    # ramp_time 0 changes speed right away.
+    def set_speed(self, speed, ramp_time = None) :
+        ramp_time = self.ramp_time if ramp_time is None else ramp_time
+        self.target = float(speed)
+        ramp_frames = ramp_time * Audio.sample_rate
+        if ramp_frames < 1:
+            self.speed = self.target
+            self.step = 0.
+        else:
+            self.step = (self.target - self.speed) / ramp_frames
+
+    def get_speed(self) :
+        return self.target
+
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, output, num_frames, num_channels) :
+        if self.speed == 1. and self.target == 1. and self.end_frame is None:
+            return self._pass_through(output, num_frames, num_channels)
+
+        if self.bypass or num_channels != self.num_channels:
+            self._start(num_channels)
+        self._alloc(num_frames)
+
+        # read position of each output frame, relative to the history buffer
+        pos = self.positions[:num_frames]
+        next_pos = self._advance(pos, num_frames)
+
+        # make sure all the input frames we need are in the history
+        idx = self.index[:num_frames]
+        np.floor(pos, out=self.frac[:num_frames])
+        idx[:] = self.frac[:num_frames]
+        frac = self.frac[:num_frames]
+        np.subtract(pos, frac, out=frac)
+        self._fill(int(idx[-1]) + self.half_taps + 1)
+
+        out2 = output.reshape(num_frames, num_channels)
+        if self.mode == 'linear':
+            self._interp_linear(out2, idx, frac, num_frames)
+        else:
+            self._interp_sinc(out2, idx, frac, num_frames)
+
+        continue_flag = self.end_frame is None or next_pos < self.end_frame
+        self._discard(next_pos)
+        return continue_flag
+
+    # speed 1: play the input as is. Input already read into the history is
+    # played out first, then the history is dropped. The last half_taps frames
+    # played are kept in tail, so that resampling can start again right after
+    # them.
+    def _pass_through(self, output, num_frames, num_channels):
+        nc = num_channels
+        if not self.bypass or nc != self.num_channels:
+            if nc != self.num_channels:
+                self.num_buffered = 0
+            self.bypass = True
+            self.num_channels = nc
+            self.pos = float(min(int(round(self.pos)), self.num_buffered))
+            self.tail = np.zeros(self.half_taps * nc, dtype=np.float32)
+
+        start = int(self.pos)
+        num_old = max(min(self.num_buffered - start, num_frames), 0)
+        output[:num_old * nc] = self.history[start * nc : (start + num_old) * nc]
+        self.pos += num_old
+
+        continue_flag = True
+        if num_old < num_frames:
+            continue_flag = generate_into(self.generator, output[num_old * nc : num_frames * nc],
+                                          num_frames - num_old, nc)
+
+        end = num_frames * nc
+        n = min(num_frames, self.half_taps) * nc
+        keep = len(self.tail) - n
+        self.tail[:keep] = self.tail[n:]
+        self.tail[keep:] = output[end - n:end]
+        return continue_flag
+
+    # history of num_channels frames, starting with the half_taps frames before
+    # the first input frame: silence, or the end of what was passed through
+    def _start(self, num_channels):
+        self.num_channels = num_channels
+        self.positions = np.empty(0)
+        self.history = np.zeros(kMinHistory * num_channels, dtype=np.float32)
+        if self.bypass:
+            self.history[:len(self.tail)] = self.tail
+            self.bypass = False
+        self.num_buffered = self.half_taps
+        self.pos = float(self.half_taps)
+        self.end_frame = None
+
+    # grow work buffers to num_frames
+    def _alloc(self, num_frames):
+        if len(self.positions) < num_frames:
+            self.positions = np.empty(num_frames)
+            self.speeds = np.empty(num_frames)
+            self.ramp = np.arange(1, num_frames + 1, dtype=np.float64)
+            self.frac = np.empty(num_frames)
+            self.index = np.empty(num_frames, dtype=np.intp)
+            self.tap_index = np.empty(num_frames, dtype=np.intp)
+            self.weights = np.empty(num_frames, dtype=np.float32)
+            self.phase = np.empty(num_frames, dtype=np.intp)
+            self.taps = np.empty((num_frames, self.num_channels), dtype=np.float32)
+
+    # fill pos with the read position of each output frame, ramping the speed
+    # along the way. Returns the read position of the frame after these.
+    def _advance(self, pos, num_frames):
+        speeds = self.speeds[:num_frames]
+        if self.step != 0.:
+            np.multiply(self.ramp[:num_frames], self.step, out=speeds)
+            speeds += self.speed
+            if self.step > 0:
+                np.minimum(speeds, self.target, out=speeds)
+            else:
+                np.maximum(speeds, self.target, out=speeds)
+            self.speed = float(speeds[-1])
+            if self.speed == self.target:
+                self.step = 0.
+        else:
+            speeds.fill(self.speed)
+
+        # the first frame is at self.pos; each frame after moves by the speed
+        # of the frame before
+        pos[0] = 0.
+        np.cumsum(speeds[:-1], out=pos[1:])
+        pos += self.pos
+        return self.pos + float(np.sum(speeds))
+
+    # read from the generator until the history holds frames up to (not
+    # including) end. Once the generator is done, pad with silence.
+    def _fill(self, end):
+        nc = self.num_channels
+        num_new = end - self.num_buffered
+        if num_new <= 0:
+            return
+
+        if len(self.history) < end * nc:
+            history = np.zeros(end * nc * 2, dtype=np.float32)
+            history[:self.num_buffered * nc] = self.history[:self.num_buffered * nc]
+            self.history = history
+
+        buf = self.history[self.num_buffered * nc : end * nc]
+        if self.end_frame is None:
+            if not generate_into(self.generator, buf, num_new, nc):
+                self.end_frame = end
+        else:
+            buf.fill(0)
+        self.num_buffered = end
+
+    # drop history that is no longer needed to read from next_pos onward
+    def _discard(self, next_pos):
+        nc = self.num_channels
+        # (at high speeds, next_pos may be past the frames read so far. Those
+        # are read on the next call.)
+        first = int(np.floor(next_pos)) - self.half_taps + 1
+        first = min(first, self.num_buffered)
+        if first <= 0:
+            self.pos = next_pos
+            return
+
+        keep = self.num_buffered - first
+        self.history[:keep * nc] = self.history[first * nc : self.num_buffered * nc]
+        self.num_buffered = keep
+        self.pos = next_pos - first
+        if self.end_frame is not None:
+            self.end_frame -= first
+
+    # (np.take's mode = 'clip' is only there so that it writes straight into
+    # out: the indices are always in range.)
+    def _interp_linear(self, out2, idx, frac, num_frames):
+        hist2 = self.history.reshape(-1, self.num_channels)
+        taps = self.taps[:num_frames]
+        w = self.weights[:num_frames]
+
+        # out = a + frac * (b - a)
+        np.take(hist2, idx, axis=0, out=out2, mode='clip')
+        np.add(idx, 1, out=self.tap_index[:num_frames])
+        np.take(hist2, self.tap_index[:num_frames], axis=0, out=taps, mode='clip')
+        taps -= out2
+        w[:] = frac
+        self._weigh(taps, w)
+        out2 += taps
+
+    def _interp_sinc(self, out2, idx, frac, num_frames):
+        self._update_table()
+        hist2 = self.history.reshape(-1, self.num_channels)
+        taps = self.taps[:num_frames]
+        tap_index = self.tap_index[:num_frames]
+        w = self.weights[:num_frames]
+        phase = self.phase[:num_frames]
+
+        # nearest table row for each frame's fractional position
+        np.multiply(frac, kSincPhases, out=frac)
+        np.rint(frac, out=frac)
+        phase[:] = frac
+
+        out2.fill(0)
+        for j in range(kSincTaps):
+            np.add(idx, j - self.half_taps + 1, out=tap_index)
+            np.take(hist2, tap_index, axis=0, out=taps, mode='clip')
+            np.take(self.table[j], phase, out=w, mode='clip')
+            self._weigh(taps, w)
+            out2 += taps
+
+    # multiply each frame of taps by its weight. One channel at a time, since
+    # broadcasting w across channels makes numpy allocate a temporary buffer.
+    def _weigh(self, taps, w):
+        for c in range(self.num_channels):
+            ch = taps[:, c]
+            np.multiply(ch, w, out=ch)
+
+    # when speeding up, lower the cutoff so the output has nothing above its
+    # Nyquist frequency
+    def _update_table(self):
+        cutoff = kSincCutoff * min(1., 1. / max(self.speed, self.target))
+        cutoff = round(cutoff, 2)
+        if cutoff != self.cutoff:
+            self.cutoff = cutoff
+            self.table = get_sinc_table(cutoff)
+
+
+kSincTaps = 16        # taps per output frame in 'sinc' mode
+kSincPhases = 512     # fractional positions in the polyphase table
+kSincCutoff = 0.95    # fraction of Nyquist passed at speed 1
+kSincBeta = 8.0       # Kaiser window shape
+kMinHistory = 1024    # starting size of the history buffer, in frames
+
+# polyphase tables already made, by cutoff
+g_sinc_tables = {}
+
+# return the polyphase table for cutoff (as a fraction of Nyquist), as an
+# array of shape (kSincTaps, kSincPhases + 1). Column p holds the weights for a
+# read position p / kSincPhases of the way between two frames. Tap j weighs the
+# frame j - kSincTaps/2 + 1 away from the frame before the read position.
+def get_sinc_table(cutoff):
+    if cutoff not in g_sinc_tables:
+        half = kSincTaps // 2
+        offsets = np.arange(kSincTaps)[:, np.newaxis] - half + 1
+        frac = np.arange(kSincPhases + 1)[np.newaxis, :] / float(kSincPhases)
+        x = offsets - frac
+
+        window = np.i0(kSincBeta * np.sqrt(np.clip(1 - (x / half) ** 2, 0, 1))) / np.i0(kSincBeta)
+        table = cutoff * np.sinc(cutoff * x) * window
+
+        # unity gain at DC for every phase
+        table /= np.sum(table, axis=0)
+        g_sinc_tables[cutoff] = table.astype(np.float32)
+    return g_sinc_tables[cutoff]
+
+
+# resample a whole array of interleaved frames from sample rate src_rate to
+# dst_rate (ie, when loading a file that doesn't match Audio.sample_rate).
+def resample_array(data, num_channels, src_rate, dst_rate, mode = 'sinc'):
+    if src_rate == dst_rate:
+        return data
+
+    num_in = len(data) // num_channels
+    num_out = int(np.ceil(num_in * float(dst_rate) / src_rate))
+    output = np.empty(num_out * num_channels, dtype=np.float32)
+
+    resampler = Resampler(_ArrayGenerator(data), float(src_rate) / dst_rate, mode)
+    block = 4096
+    for start in range(0, num_out, block):
+        n = min(block, num_out - start)
+        resampler.generate_into(output[start * num_channels : (start + n) * num_channels],
+                                n, num_channels)
+    return output
+
+
+# generator that plays back an array of interleaved samples, then silence
+class _ArrayGenerator(object):
+    def __init__(self, data):
+        super(_ArrayGenerator, self).__init__()
+        self.data = data
+        self.idx = 0
+
+    def generate_into(self, output, num_frames, num_channels):
+        n = min(len(output), len(self.data) - self.idx)
+        output[:n] = self.data[self.idx : self.idx + n]
+        output[n:] = 0
+        self.idx += n
+        return self.idx < len(self.data)
@@ -0,0 +1,87 @@
+import numpy as np
+
+# Fixed-size ring buffer of float32 samples, for handing audio from one thread
+# to another without locks or allocation. There must be only one writer thread
+# and one reader thread. Each side only changes its own counter, and a counter
+# only moves after the samples are copied, so the other side never sees
+# partially written data.
+# The writer can also use overwrite() to keep a history of the most recent
+# samples (ie, mic input), and readers can look back at any part of that
+# history with read_at().
+class RingBuffer(object):
+    def __init__(self, capacity):
+        super(RingBuffer, self).__init__()
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+
+        # total samples ever written / read. They only increase.
+        self.write_count = 0
+        self.read_count = 0
+
+    def get_read_available(self):
+        return min(self.write_count - self.read_count, self.capacity)
+
+    def get_write_available(self):
+        return self.capacity - (self.write_count - self.read_count)
+
+    # write all of data, or nothing if there isn't room. Returns True if written.
+    def write(self, data):
+        n = len(data)
+        if n > self.get_write_available():
+            return False
+
+        start = self.write_count % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start : start + first] = data[:first]
+        self.buffer[:n - first] = data[first:]
+
+        self.write_count += n
+        return True
+
+    # write all of data, overwriting the oldest samples if there isn't room.
+    # Overwritten samples that were not read yet are lost.
+    def overwrite(self, data):
+        if len(data) > self.capacity:
+            self.write_count += len(data) - self.capacity
+            data = data[-self.capacity:]
+
+        n = len(data)
+        start = self.write_count % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start : start + first] = data[:first]
+        self.buffer[:n - first] = data[first:]
+
+        self.write_count += n
+
+    # copy the len(output) samples that end at sample count end_count (counting
+    # all samples ever written) into output, without reading them. Returns False
+    # if those samples are not written yet or were already overwritten.
+    def read_at(self, output, end_count):
+        n = len(output)
+        start_count = end_count - n
+        if end_count > self.write_count or start_count < self.write_count - self.capacity:
+            return False
+
+        start = start_count % self.capacity
+        first = min(n, self.capacity - start)
+        output[:first] = self.buffer[start : start + first]
+        output[first:] = self.buffer[:n - first]
+
+        # the writer may have overwritten these samples while we copied
+        return start_count >= self.write_count - self.capacity
+
+    # read up to len(output) samples into output. Returns the number read.
+    def read(self, output):
+        # skip samples lost to overwrite()
+        if self.write_count - self.read_count > self.capacity:
+            self.read_count = self.write_count - self.capacity
+
+        n = min(len(output), self.get_read_available())
+
+        start = self.read_count % self.capacity
+        first = min(n, self.capacity - start)
+        output[:first] = self.buffer[start : start + first]
+        output[first:n] = self.buffer[:n - first]
+
+        self.read_count += n
+        return n
@@ -12,10 +12,26 @@ import numpy as np
 from . import fluidsynth
 from .audio import Audio
 
+# FluidSynth renders audio internally in blocks of this many frames. A MIDI
+# message takes effect at the start of the first internal block that is
+# rendered after the message is sent.
+kFluidBlockSize = 64
+
 # create another kind of generator that generates audio based on the fluid
 # synth synthesizer
 class Synth(fluidsynth.Synth, object):
     def __init__(self, filepath, gain = 0.8):
+        # frames rendered so far - tells us where FluidSynth's internal blocks start
+        self.frames_rendered = 0
+
+        # MIDI messages deferred to the next generate() call, as
+        # (frame offset, function, args). See set_event_offset().
+        self.event_offset = None
+        self.events = []
+
+        # buffer returned by generate(), reused on every call
+        self.buffer = np.empty(0, dtype=np.float32)
+
         super(Synth, self).__init__(gain, samplerate=Audio.sample_rate)
         self.sfid = self.sfload(filepath)
         if self.sfid == -1:
@@ -25,10 +41,86 @@ class Synth(fluidsynth.Synth, object):
     def program(self, chan, bank, preset):
         self.program_select(chan, self.sfid, bank, preset)
 
+    # Used by AudioScheduler(batch_events = True): MIDI messages sent after this
+    # call are not sent right away but queued, to happen offset frames into the
+    # next generated buffer. The buffer is then rendered in as few calls as
+    # possible. set_event_offset(None) sends messages right away again.
+    def set_event_offset(self, offset):
+        self.event_offset = offset
+
+    def noteon(self, chan, key, vel):
+        return self._midi(fluidsynth.Synth.noteon, chan, key, vel)
+
+    def noteoff(self, chan, key):
+        return self._midi(fluidsynth.Synth.noteoff, chan, key)
+
+    def pitch_bend(self, chan, val):
+        return self._midi(fluidsynth.Synth.pitch_bend, chan, val)
+
+    def cc(self, chan, ctrl, val):
+        return self._midi(fluidsynth.Synth.cc, chan, ctrl, val)
+
+    def program_change(self, chan, prg):
+        return self._midi(fluidsynth.Synth.program_change, chan, prg)
+
+    def program_select(self, chan, sfid, bank, preset):
+        return self._midi(fluidsynth.Synth.program_select, chan, sfid, bank, preset)
+
+    def _midi(self, func, *args):
+        if self.event_offset is None:
+            return func(self, *args)
+        self.events.append((self.event_offset, func, args))
+
+    # the returned data is only valid until the next call to generate(). Use
+    # generate_into() to render into your own buffer.
     def generate(self, num_frames, num_channels):
+        size = num_frames * num_channels
+        if len(self.buffer) < size:
+            self.buffer = np.empty(size, dtype=np.float32)
+        output = self.buffer[:size]
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
+
+    def generate_into(self, output, num_frames, num_channels):
         assert(num_channels == 2)
-        # get_samples() returns interleaved stereo, so all we have to do is scale
-        # the data to [-1, 1].
-        samples = self.get_samples(num_frames).astype(np.float32)
-        samples *= (1.0/32768.0)
-        return (samples, True)
+
+        # send queued MIDI messages. Messages that fall in the same internal
+        # FluidSynth block all take effect at the start of that block, so we
+        # only have to stop rendering once per block that has messages. This
+        # sounds exactly the same as rendering up to each message's frame.
+        events = self.events
+        self.event_offset = None
+        first_frame = self.frames_rendered
+        start = 0
+        i = 0
+        while i < len(events):
+            boundary = self._block_boundary(first_frame, events[i][0], num_frames)
+            if boundary > start:
+                self._render(output[start * 2 : boundary * 2], boundary - start)
+                start = boundary
+
+            while i < len(events) and \
+                    self._block_boundary(first_frame, events[i][0], num_frames) == boundary:
+                offset, func, args = events[i]
+                func(self, *args)
+                i += 1
+
+        del events[:]
+
+        if start < num_frames:
+            self._render(output[start * 2:], num_frames - start)
+        return True
+
+    # frame (within the buffer starting at first_frame, clipped to num_frames)
+    # at which a message sent at offset will take effect
+    def _block_boundary(self, first_frame, offset, num_frames):
+        frame = first_frame + offset
+        frame += -frame % kFluidBlockSize
+        return min(frame - first_frame, num_frames)
+
+    # render num_frames of interleaved stereo into output. FluidSynth writes
+    # float samples in [-1, 1] directly into output - no int16 conversion,
+    # copy, or allocation.
+    def _render(self, output, num_frames):
+        self.write_samples(output, num_frames)
+        self.frames_rendered += num_frames
@@ -0,0 +1,219 @@
+import numpy as np
+from .mixer import GainRamp
+from .wavegen import read_frames_into
+from .fftutil import rfft_into, irfft_into
+
+kFFTSize = 2048                 # analysis / synthesis window, in frames
+kHopSize = kFFTSize // 4        # synthesis hop, in frames
+
+
+# Plays a WaveSource (ie, WaveFile, WaveBuffer) at a different tempo without
+# changing its pitch, using a phase vocoder. rate is the tempo: 0.5 plays at
+# half speed, 2.0 at double speed.
+#
+# Each hop of kHopSize output frames comes from two analysis frames
+# kHopSize apart, read at the current position in the source. The phase
+# difference between them is the phase advance of each bin over one output
+# hop, which is added to the phase of the previous output frame. The frames
+# are then overlap-added. The source position moves by rate * kHopSize each hop.
+#
+# Windows and FFT buffers are made once, so the per-buffer cost is a few
+# FFTs per channel per hop and no allocation.
+class TimeStretcher(object):
+    def __init__(self, wave_source, rate = 1.0, loop = False):
+        super(TimeStretcher, self).__init__()
+        self.source = wave_source
+        self.num_channels = wave_source.get_num_channels()
+        self.rate = rate
+        self.loop = loop
+        self.paused = False
+        self._release = False
+        self.gain = GainRamp(1.0)
+
+        N = kFFTSize
+        nc = self.num_channels
+        num_bins = N // 2 + 1
+
+        # hann window, applied at analysis and synthesis. At a hop of N/4, the
+        # squared windows overlap-add to 1.5, which we divide out.
+        self.window = np.hanning(N + 1)[:N]
+        self.synth_window = self.window / 1.5
+
+        self.frames = np.empty((N + kHopSize) * nc, dtype=np.float32)
+        self.windowed = np.empty(N)
+        self.spec1 = np.empty(num_bins, dtype=np.complex128)
+        self.spec2 = np.empty(num_bins, dtype=np.complex128)
+        # magnitudes are kept in a complex array (with zero imaginary part), so
+        # dividing complex spectra by them doesn't need a type conversion
+        self.mag = np.zeros(num_bins, dtype=np.complex128)
+        self.phase = np.ones((nc, num_bins), dtype=np.complex128)
+        self.signal = np.empty(N)
+
+        # overlap-add accumulator. Shifting it in place would make numpy copy
+        # through a temporary array, so we shift into a second one and swap.
+        self.ola = np.zeros((N, nc))
+        self.ola_next = np.zeros((N, nc))
+        self.ready = np.zeros((kHopSize, nc), dtype=np.float32)
+        self.reset()
+        self.paused = False
+
+    def reset(self):
+        self.paused = True
+        # source frame of the next analysis frame. Output frames come from the
+        # second analysis frame of each pair, kHopSize later, so starting one
+        # hop early (on silence) makes the output start at source frame 0.
+        self.position = float(-kHopSize)
+        self.length = None     # source length, once we reach the end
+        self.empty_hops = 0    # hops made since the source ran out
+        self.done = False
+        self.first = True
+        self.ola.fill(0)
+        self.ready_pos = kHopSize   # nothing ready yet
+        if hasattr(self.source, 'seek'):
+            self.source.seek(0)
+
+    def play_toggle(self):
+        self.paused = not self.paused
+
+    def play(self):
+        self.paused = False
+
+    def pause(self):
+        self.paused = True
+
+    def release(self):
+        self._release = True
+
+    # ramp_time > 0 fades to the new gain over that many seconds (see GainRamp)
+    def set_gain(self, g, ramp_time = 0., shape = 'linear'):
+        self.gain.set(g, ramp_time, shape)
+
+    def get_gain(self):
+        return self.gain.get()
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def get_rate(self):
+        return self.rate
+
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, output, num_frames, num_channels) :
+        assert(num_channels == self.num_channels)
+        if self.paused:
+            output.fill(0)
+            return True
+
+        out2 = output.reshape(num_frames, num_channels)
+        filled = 0
+        while filled < num_frames:
+            if self.ready_pos == kHopSize:
+                if self.done:
+                    out2[filled:] = 0
+                    break
+                self._hop()
+                self.ready_pos = 0
+
+            n = min(num_frames - filled, kHopSize - self.ready_pos)
+            out2[filled : filled + n] = self.ready[self.ready_pos : self.ready_pos + n]
+            self.ready_pos += n
+            filled += n
+
+        self.gain.apply(output, num_frames, num_channels)
+
+        continue_flag = not (self.done and self.ready_pos == kHopSize)
+        if self._release:
+            continue_flag = False
+        return continue_flag
+
+    # make the next kHopSize output frames in self.ready
+    def _hop(self):
+        N = kFFTSize
+        nc = self.num_channels
+        num_read = self._read(int(self.position))
+
+        # once the source runs out, the overlap-add buffer still holds the
+        # tails of the last frames. Play them out, which takes N / kHopSize
+        # hops, before stopping.
+        if num_read == 0:
+            self.empty_hops += 1
+            self.done = self.empty_hops == N // kHopSize
+
+        frames = self.frames.reshape(N + kHopSize, nc)
+        for c in range(nc):
+            self._rfft(frames[:N, c], self.spec1)
+            self._rfft(frames[kHopSize:, c], self.spec2)
+
+            # phase advance over one hop: spec2 * conj(spec1), normalized.
+            # The first frame just takes the phase of spec2.
+            phase = self.phase[c]
+            if not self.first:
+                np.conjugate(self.spec1, out=self.spec1)
+                np.multiply(self.spec1, self.spec2, out=self.spec1)
+                self._normalize(self.spec1, self.spec1)
+                phase *= self.spec1
+            else:
+                self._normalize(self.spec2, phase)
+
+            # output frame: magnitude of spec2 with the accumulated phase
+            np.abs(self.spec2, out=self.mag.real)
+            np.multiply(phase, self.mag, out=self.spec2)
+            irfft_into(self.spec2, kFFTSize, self.signal)
+            self.signal *= self.synth_window
+            self.ola[:, c] += self.signal
+
+            # keep the phase accumulator at unit magnitude
+            self._normalize(phase, phase)
+
+        self.first = False
+
+        # first kHopSize frames are finished. Shift the rest down.
+        self.ready[:] = self.ola[:kHopSize]
+        self.ola_next[:-kHopSize] = self.ola[kHopSize:]
+        self.ola_next[-kHopSize:] = 0
+        self.ola, self.ola_next = self.ola_next, self.ola
+
+        self.position += self.rate * kHopSize
+        if self.loop and self.length:
+            self.position %= self.length
+
+    # read the N + kHopSize frames starting at source frame start into
+    # self.frames, zero-padding before the start and past the end (or wrapping
+    # around if looping). Returns the number of frames read from the source.
+    def _read(self, start):
+        nc = self.num_channels
+        total = kFFTSize + kHopSize
+        if self.length is not None and start >= self.length:
+            self.frames.fill(0)
+            return 0
+
+        pad = max(-start, 0)
+        self.frames[:pad * nc] = 0
+        num_read = read_frames_into(self.source, self.frames[pad * nc:], start + pad,
+                                    total - pad, nc)
+        filled = pad + num_read
+        if filled < total:
+            self.length = start + filled
+            while self.loop and filled < total and self.length > 0:
+                n = read_frames_into(self.source, self.frames[filled * nc:], 0,
+                                     total - filled, nc)
+                filled += n
+                num_read += n
+        self.frames[filled * nc:] = 0
+        return num_read
+
+    # out = spec / |spec|
+    def _normalize(self, spec, out):
+        mag = self.mag.real
+        np.abs(spec, out=mag)
+        mag += 1e-20
+        np.divide(spec, self.mag, out=out)
+
+    def _rfft(self, x, spec):
+        self.windowed[:] = x
+        self.windowed *= self.window
+        rfft_into(self.windowed, spec)
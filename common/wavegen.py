@@ -9,7 +9,11 @@
 #####################################################################
 
 
+import time
 import numpy as np
+from .audio import Audio
+from .mixer import GainRamp
+from .resample import Resampler
 
 # generates audio data by asking an audio-source (ie, WaveFile) for that data.
 class WaveGenerator(object):
@@ -20,12 +24,16 @@ class WaveGenerator(object):
         self.frame = 0
         self.paused = False
         self._release = False
-        self.gain = 1.0
+        self.gain = GainRamp(1.0)
 
     def reset(self):
         self.paused = True
         self.frame = 0
 
+        # let sources that read ahead (ie, PrefetchWaveSource) start over now
+        if hasattr(self.source, 'seek'):
+            self.source.seek(0)
+
     def play_toggle(self):
         self.paused = not self.paused
 
@@ -38,81 +46,349 @@ class WaveGenerator(object):
     def release(self):
         self._release = True
 
-    def set_gain(self, g):
-        self.gain = g
+    # ramp_time > 0 fades to the new gain over that many seconds (see GainRamp)
+    def set_gain(self, g, ramp_time = 0., shape = 'linear'):
+        self.gain.set(g, ramp_time, shape)
 
     def get_gain(self):
-        return self.gain
+        return self.gain.get()
 
     def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, output, num_frames, num_channels) :
         if self.paused:
-            output = np.zeros(num_frames * num_channels)
-            return (output, True)
+            output.fill(0)
+            return True
 
-        else:
-            # get data based on our position and requested # of frames
-            output = self.source.get_frames(self.frame, self.frame + num_frames)
+        # get data based on our position and requested # of frames
+        actual_num_frames = self._read_into(output, self.frame, num_frames, num_channels)
+
+        # check for end-of-buffer condition:
+        continue_flag = actual_num_frames == num_frames
+
+        # advance current-frame
+        self.frame += actual_num_frames
 
-            # check for end-of-buffer condition:
-            actual_num_frames = len(output) // num_channels
-            continue_flag = actual_num_frames == num_frames
+        # looping. If we got to the end of the buffer, don't actually end.
+        # Instead, read some more from the beginning
+        if self.loop and not continue_flag:
+            continue_flag = True
+            remainder = num_frames - actual_num_frames
+            self.frame = self._read_into(output[actual_num_frames * num_channels:],
+                                         0, remainder, num_channels)
+            actual_num_frames += self.frame
 
-            # advance current-frame
-            self.frame += actual_num_frames
+        if self._release:
+            continue_flag = False
 
-            # looping. If we got to the end of the buffer, don't actually end.
-            # Instead, read some more from the beginning
-            if self.loop and not continue_flag:
-                continue_flag = True
-                remainder = num_frames - actual_num_frames
-                output = np.append(output, self.source.get_frames(0, remainder))
-                self.frame = remainder
+        # zero-pad if output is too short (may happen if not looping / end of buffer)
+        output[actual_num_frames * num_channels:] = 0
 
-            if self._release:
-                continue_flag = False
+        self.gain.apply(output, num_frames, num_channels)
+        return continue_flag
 
-            # zero-pad if output is too short (may happen if not looping / end of buffer)
-            shortfall = num_frames * num_channels - len(output)
-            if shortfall > 0:
-                output = np.append(output, np.zeros(shortfall))
+    def _read_into(self, output, start_frame, num_frames, num_channels) :
+        return read_frames_into(self.source, output, start_frame, num_frames, num_channels)
 
-            # return
-            return (output * self.gain, continue_flag)
 
+# Plays the stems of a song (a StemSource, or any WaveSource that puts the
+# stems' channels side by side) in lock-step: all stems share one frame cursor
+# and are read with one call per buffer, so they can never drift apart.
+# Each stem has its own gain, with ramps (see GainRamp).
+# seek() only takes effect at the start of the next buffer, so all stems move
+# together even when called from another thread.
+# num_channels is the number of channels of each stem (and of the output).
+#
+# get_time() is the song position the listener is hearing right now, for
+# keeping game logic in sync with the audio (see get_time).
+class MultiTrackGenerator(object):
+    def __init__(self, stem_source, loop = False, num_channels = 2):
+        super(MultiTrackGenerator, self).__init__()
+        assert(stem_source.get_num_channels() % num_channels == 0)
+        self.source = stem_source
+        self.num_channels = num_channels
+        self.num_stems = stem_source.get_num_channels() // num_channels
+        self.loop = loop
+        self.frame = 0
+        self.pending_seek = None
+        self.paused = False
+        self._release = False
+        self.gains = [GainRamp(1.0) for i in range(self.num_stems)]
 
+        # the last buffer rendered, as one tuple so that the main thread
+        # always sees a consistent one: (first frame, frame after the last,
+        # perf_counter() time, jump count, loop length). The jump count goes up
+        # when the cursor jumps (seek, loop), to reset get_time's clamp. The
+        # loop length is the source's length in frames, once it has looped.
+        self.rendered = (0, 0, time.perf_counter(), 0, 0)
+        self.jumps = 0
+        self.loop_length = 0
+        self.last_time = (0, 0.)
 
-class SpeedModulator(object):
-    def __init__(self, generator, speed = 1.0):
-        super(SpeedModulator, self).__init__()
-        self.generator = generator
-        self.speed = speed
+        # all stems for one buffer, and one stem's share of it
+        self.block = np.empty(0, dtype=np.float32)
+        self.scratch = np.empty(0, dtype=np.float32)
 
-    def set_speed(self, speed) :
-        self.speed = speed
+    def reset(self):
+        self.paused = True
+        self.seek(0)
 
-    def generate(self, num_frames, num_channels) :
-        # optimization if speed is 1.0
-        if self.speed == 1.0:
-            return self.generator.generate(num_frames, num_channels)
+    # move all stems to frame
+    def seek(self, frame):
+        self.pending_seek = frame
+        if hasattr(self.source, 'seek'):
+            self.source.seek(frame)
+
+    def get_frame(self):
+        return self.frame
+
+    def play_toggle(self):
+        self.paused = not self.paused
 
-        # otherwise, we need to ask self.generator for a number of frames that is
-        # larger or smaller than num_frames, depending on self.speed
-        adj_frames = int(round(num_frames * self.speed))
+    def play(self):
+        self.paused = False
 
-        # get data from generator
-        data, continue_flag = self.generator.generate(adj_frames, num_channels)
+    def pause(self):
+        self.paused = True
 
-        # split into multi-channels:
-        data_chans = [ data[n::num_channels] for n in range(num_channels) ]
+    def release(self):
+        self._release = True
 
-        # stretch or squash data to fit exactly into num_frames
-        from_range = np.arange(adj_frames)
-        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
-        resampled = [ np.interp(to_range, from_range, data_chans[n]) for n in range(num_channels) ]
+    # ramp_time > 0 fades stem to the new gain over that many seconds
+    def set_gain(self, stem, g, ramp_time = 0., shape = 'linear'):
+        self.gains[stem].set(g, ramp_time, shape)
 
-        # convert back by interleaving into a single buffer
-        output = np.empty(num_channels * num_frames, dtype=np.float32)
-        for n in range(num_channels) :
-            output[n::num_channels] = resampled[n]
+    def get_gain(self, stem):
+        return self.gains[stem].get()
 
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
         return (output, continue_flag)
+
+    # Song position, in seconds, of the frame coming out of the speakers now.
+    # latency is the time from rendering a buffer to hearing it (ie,
+    # Audio.get_output_latency()). Between buffers, the position moves on with
+    # the clock, so it is smooth even though audio is rendered in blocks. It
+    # never goes backwards, except after a seek or a loop.
+    # While paused, it runs on until the audio rendered before the pause has
+    # been heard. Just after a loop, frames before the loop point are still
+    # being heard, so the time wraps back to the end of the song.
+    # Call from any thread, as often as needed: it does no work per frame.
+    def get_time(self, latency = 0.):
+        start, end, t, jumps, loop_length = self.rendered
+        frame = start + (time.perf_counter() - t - latency) * Audio.sample_rate
+        frame = min(frame, end)
+        if frame < 0 and loop_length:
+            # (from before the jump, as far as the clamp is concerned)
+            frame += loop_length
+            jumps -= 1
+        now = float(frame) / Audio.sample_rate
+
+        last_jumps, last_time = self.last_time
+        if jumps == last_jumps and now < last_time:
+            now = last_time
+        self.last_time = (jumps, now)
+        return now
+
+    def generate_into(self, output, num_frames, num_channels) :
+        if self.pending_seek is not None:
+            self.frame = self.pending_seek
+            self.pending_seek = None
+            self.jumps += 1
+
+        assert(num_channels == self.num_channels)
+        if self.paused:
+            # the last buffer played still counts (see get_time), unless the
+            # cursor moved since
+            if self.rendered[3] != self.jumps:
+                self.rendered = (self.frame, self.frame, time.perf_counter(), self.jumps,
+                                 self.loop_length)
+            output.fill(0)
+            return True
+
+        start_frame = self.frame
+        t_render = time.perf_counter()
+
+        all_channels = self.num_stems * num_channels
+        size = num_frames * all_channels
+        if len(self.block) < size:
+            self.block = np.empty(size, dtype=np.float32)
+            self.scratch = np.empty(num_frames * num_channels, dtype=np.float32)
+        block = self.block[:size]
+
+        # read all stems, looping like WaveGenerator
+        actual_num_frames = read_frames_into(self.source, block, self.frame, num_frames, all_channels)
+        continue_flag = actual_num_frames == num_frames
+        self.frame += actual_num_frames
+
+        if self.loop and not continue_flag:
+            continue_flag = True
+            self.loop_length = self.frame
+            remainder = num_frames - actual_num_frames
+            self.frame = read_frames_into(self.source, block[actual_num_frames * all_channels:],
+                                          0, remainder, all_channels)
+            actual_num_frames += self.frame
+            # counted from the loop point, so the first frames are negative
+            start_frame = self.frame - actual_num_frames
+            self.jumps += 1
+
+        self.rendered = (start_frame, self.frame, t_render, self.jumps, self.loop_length)
+        block[actual_num_frames * all_channels:] = 0
+        if self._release:
+            continue_flag = False
+
+        # mix the stems, skipping muted ones
+        block2 = block.reshape(num_frames, all_channels)
+        scratch = self.scratch[:num_frames * num_channels]
+        filled = False
+        for s, gain in enumerate(self.gains):
+            if gain.get() == 0 and not gain.is_ramping():
+                continue
+            dst = scratch if filled else output
+            dst.reshape(num_frames, num_channels)[:] = \
+                block2[:, s * num_channels : (s + 1) * num_channels]
+            gain.apply(dst, num_frames, num_channels)
+            if filled:
+                output += scratch
+            filled = True
+
+        if not filled:
+            output.fill(0)
+        return continue_flag
+
+
+# copy frames from a WaveSource into output, returning the number of frames
+# actually read. Sources that support get_frames_into() write directly.
+def read_frames_into(source, output, start_frame, num_frames, num_channels) :
+    if hasattr(source, 'get_frames_into'):
+        return source.get_frames_into(output, start_frame, start_frame + num_frames)
+
+    data = source.get_frames(start_frame, start_frame + num_frames)
+    output[:len(data)] = data
+    return len(data) // num_channels
+
+
+# Plays short sounds (WaveSources, ie WaveBuffers) on a fixed number of voices.
+# Add it to a Mixer once and call trigger() for each sound, instead of adding
+# a new WaveGenerator every time. The cost per buffer is bounded by num_voices
+# no matter how often sounds are triggered.
+#   max_per_source - how many voices one source can use at once. Triggering a
+#                    source beyond that restarts its oldest voice. 0 = no limit
+#   steal - when all voices are busy: 'oldest' takes the voice that started
+#           first, 'quietest' takes the one with the lowest gain.
+class VoicePool(object):
+    def __init__(self, num_voices = 8, max_per_source = 1, steal = 'oldest'):
+        super(VoicePool, self).__init__()
+        assert(steal in ('oldest', 'quietest'))
+
+        self.voices = [Voice() for i in range(num_voices)]
+        self.max_per_source = max_per_source
+        self.steal = steal
+        self.gain = 1.0
+        self.num_triggers = 0
+        self.scratch = np.empty(0, dtype=np.float32)
+
+    # start playing source from the beginning. Returns the voice used.
+    def trigger(self, source, gain = 1.0):
+        voice = None
+
+        if self.max_per_source:
+            playing = [v for v in self.voices if v.source is source]
+            if len(playing) >= self.max_per_source:
+                voice = min(playing, key = lambda v: v.order)
+
+        if voice is None:
+            voice = self._find_free_voice()
+
+        voice.start(source, gain, self.num_triggers)
+        self.num_triggers += 1
+        return voice
+
+    # stop all voices playing source, or all voices if source is None
+    def stop(self, source = None):
+        for v in self.voices:
+            if source is None or v.source is source:
+                v.stop()
+
+    def set_gain(self, g):
+        self.gain = g
+
+    def get_gain(self):
+        return self.gain
+
+    def get_num_active(self):
+        return sum(1 for v in self.voices if v.source is not None)
+
+    def _find_free_voice(self):
+        for v in self.voices:
+            if v.source is None:
+                return v
+
+        # all voices busy - steal one
+        if self.steal == 'quietest':
+            return min(self.voices, key = lambda v: (v.gain, v.order))
+        else:
+            return min(self.voices, key = lambda v: v.order)
+
+    def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype=np.float32)
+        self.generate_into(output, num_frames, num_channels)
+        return (output, True)
+
+    def generate_into(self, output, num_frames, num_channels) :
+        size = num_frames * num_channels
+        if len(self.scratch) < size:
+            self.scratch = np.empty(size, dtype=np.float32)
+
+        output.fill(0)
+        for v in self.voices:
+            if v.source is None:
+                continue
+
+            n = read_frames_into(v.source, self.scratch, v.frame, num_frames, num_channels)
+            signal = self.scratch[:n * num_channels]
+            signal *= v.gain
+            output[:n * num_channels] += signal
+
+            # voice is free again once its source runs out
+            v.frame += n
+            if n < num_frames:
+                v.stop()
+
+        if self.gain != 1.0:
+            output *= self.gain
+
+        # the pool itself never finishes
+        return True
+
+
+# one voice of a VoicePool
+class Voice(object):
+    def __init__(self):
+        super(Voice, self).__init__()
+        self.stop()
+
+    def start(self, source, gain, order):
+        self.source = source
+        self.gain = gain
+        self.order = order
+        self.frame = 0
+
+    def stop(self):
+        self.source = None
+        self.gain = 0
+        self.order = -1
+        self.frame = 0
+
+
+
+# Plays generator back at a different speed (changing pitch and tempo together).
+# See Resampler in resample.py: speed changes ramp over ramp_time seconds, and
+# mode can be 'linear' or 'sinc' (higher quality).
+class SpeedModulator(Resampler):
+    def __init__(self, generator, speed = 1.0, mode = 'linear', ramp_time = 0.02):
+        super(SpeedModulator, self).__init__(generator, speed, mode, ramp_time)
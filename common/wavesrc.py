@@ -10,7 +10,25 @@
 
 import numpy as np
 import wave
-from .audio import Audio
+import mmap
+import os.path
+import struct
+import threading
+import hashlib
+import io
+import json
+import shutil
+import subprocess
+from collections import OrderedDict
+from .audio import Audio, CACHE_DIR
+from .resample import resample_array
+from .writer import WaveWriter
+
+# optional: decodes FLAC and OGG (and more), if installed
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
 
 # Interface for reading data from a wave file. Does not store this data locally.
 # Simple call to get_frames() to get data in format we like (numpy array, float32)
@@ -18,14 +36,12 @@ class WaveFile(object):
     def __init__(self, filepath) :
         super(WaveFile, self).__init__()
 
-        self.wave = wave.open(filepath)
+        # files at other sample rates (or in other formats) are read from a
+        # converted copy. See get_wave_at_rate().
+        self.wave = wave.open(get_wave_at_rate(filepath))
         self.num_channels, self.sampwidth, self.sr, self.end, \
            comptype, compname = self.wave.getparams()
 
-        # for now, we will only accept 16 bit files and the sample rate must match
-        assert(self.sampwidth == 2)
-        assert(self.sr == Audio.sample_rate)
-
     # read an arbitrary chunk of data from the file
     def get_frames(self, start_frame, end_frame) :
         # get the raw data from wave file as a byte string. If asking for more than is available, it just
@@ -34,7 +50,7 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(end_frame - start_frame)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         samples = samples.astype(np.float32)
@@ -45,6 +61,261 @@ class WaveFile(object):
     def get_num_channels(self):
         return self.num_channels
 
+
+# Same interface as WaveFile, but the PCM data of the file is memory-mapped
+# once and get_frames() converts only the requested slice - no seeking or
+# reading per call. Does not hold a file handle, and all MappedWaveFiles of the
+# same file share one mapping, so any number of WaveGenerators can read the
+# same asset at once.
+class MappedWaveFile(object):
+    def __init__(self, filepath) :
+        super(MappedWaveFile, self).__init__()
+
+        # same as WaveFile: other rates / formats are read from a converted copy
+        path = get_wave_at_rate(filepath)
+        self.data, self.num_channels, self.sampwidth, self.sr = map_wave_file(path)
+        self.end = len(self.data) // self.num_channels
+
+    # read an arbitrary chunk of data from the file
+    def get_frames(self, start_frame, end_frame) :
+        # zero-copy int16 view of just the samples we want
+        raw = self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+
+        # convert from integer type to floating point, and scale to [-1, 1]
+        samples = raw.astype(np.float32)
+        samples *= (1 / 32768.0)
+        return samples
+
+    # like get_frames(), but convert directly into output (float32). Returns
+    # the number of frames written.
+    def get_frames_into(self, output, start_frame, end_frame) :
+        raw = self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+        n = len(raw)
+        np.multiply(raw, kInt16Scale, out=output[:n], dtype=np.float32)
+        return n // self.num_channels
+
+    def get_num_channels(self):
+        return self.num_channels
+
+
+kInt16Scale = np.float32(1 / 32768.0)
+
+# mappings of wave files that are already open, by absolute path
+g_wave_maps = {}
+
+# memory-map the data chunk of a wave file. Returns
+# (samples, num_channels, sampwidth, sample_rate), where samples is a read-only
+# int16 numpy view of the whole data chunk. Mappings are shared by path.
+def map_wave_file(filepath):
+    path = os.path.abspath(filepath)
+    if path not in g_wave_maps:
+        with open(path, 'rb') as f:
+            fmt, data_offset, data_size = _read_wave_chunks(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        num_channels, sr, sampwidth = fmt
+        count = min(data_size, len(mm) - data_offset) // 2
+        samples = np.frombuffer(mm, dtype='<i2', count=count, offset=data_offset)
+        g_wave_maps[path] = (samples, num_channels, sampwidth, sr)
+
+    return g_wave_maps[path]
+
+# walk the RIFF chunks of a wave file. Returns
+# ((num_channels, sample_rate, sampwidth), data_offset, data_size)
+def _read_wave_chunks(f):
+    riff, size, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise IOError('not a wave file: ' + f.name)
+
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise IOError('no data chunk in wave file: ' + f.name)
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+
+        if chunk_id == b'fmt ':
+            tag, num_channels, sr, byte_rate, align, bits = \
+                struct.unpack('<HHIIHH', f.read(16))
+            # PCM or WAVE_FORMAT_EXTENSIBLE
+            if tag not in (1, 0xFFFE):
+                raise IOError('wave file is not PCM: ' + f.name)
+            fmt = (num_channels, sr, bits // 8)
+            f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise IOError('data chunk before fmt chunk in wave file: ' + f.name)
+            return fmt, f.tell(), chunk_size
+
+        else:
+            # chunks are padded to an even number of bytes
+            f.seek(chunk_size + (chunk_size & 1), 1)
+
+
+# Decoders turn an audio file into (data, num_channels, sample_rate), where
+# data is a float32 numpy array of interleaved samples in [-1, 1]. They are
+# registered by file extension, so more formats can be added with
+# register_decoder(). Built in:
+#   .wav         - 16-bit PCM, always available
+#   .flac, .ogg  - with the soundfile module (libsndfile), if installed
+#   .flac        - otherwise, with the flac command line tool, if installed
+g_decoders = {}
+
+def register_decoder(extensions, decoder):
+    for ext in extensions:
+        g_decoders[ext.lower()] = decoder
+
+# decode a file with the decoder for its extension. Raises IOError if there
+# is none.
+def decode_file(filepath):
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext not in g_decoders:
+        raise IOError('no decoder for %s files: %s' % (ext, filepath))
+    return g_decoders[ext](filepath)
+
+# decode a file at Audio.sample_rate. Returns (data, num_channels).
+# Wave files at other rates or sample widths are converted once to a 16-bit
+# wave (see get_wave_at_rate()). Other formats are decoded to float32 as is;
+# if they are at another rate, the resampled data is kept in CACHE_DIR as a
+# float32 .npy file and memory-mapped, so it is only resampled once.
+def load_audio_file(filepath):
+    ext = os.path.splitext(filepath)[1].lower()
+    if g_decoders.get(ext) is decode_wave:
+        data, num_channels, sr = decode_wave(get_wave_at_rate(filepath))
+        return data, num_channels
+
+    name = 'resampled_%s_%d.npy' % (_hash_file(filepath), Audio.sample_rate)
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(path):
+        data, num_channels, sr = decode_file(filepath)
+        if sr == Audio.sample_rate:
+            return data, num_channels
+
+        print('resampling %s to %d Hz' % (filepath, Audio.sample_rate))
+        data = resample_array(data, num_channels, sr, Audio.sample_rate)
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp = path + '.tmp.npy'
+        np.save(tmp, data.reshape(-1, num_channels))
+        os.replace(tmp, path)
+
+    frames = np.load(path, mmap_mode='r')
+    return frames.reshape(-1), frames.shape[1]
+
+# Converted files are kept in CACHE_DIR, so each file is only decoded and
+# resampled once per machine. They are named by a hash of the original file's
+# contents and the target rate, so a changed file is converted again, and the
+# same file under two names is only converted once.
+
+# file hashes already computed, as {absolute path: [size, modification time,
+# hash]}. They are also kept in CACHE_DIR/kHashIndex, so a file that hasn't
+# changed since an earlier run isn't read again just to find its cache entry.
+kHashIndex = 'file_hashes.json'
+g_file_hashes = None
+
+# return the path of a 16-bit wave file at sample_rate (default:
+# Audio.sample_rate) with the audio of filepath. That's filepath itself if it
+# already is one. Otherwise, it is converted the first time it's asked for.
+def get_wave_at_rate(filepath, sample_rate = None):
+    sample_rate = sample_rate or Audio.sample_rate
+    if _is_wave_at_rate(filepath, sample_rate):
+        return filepath
+
+    name = 'resampled_%s_%d.wav' % (_hash_file(filepath), sample_rate)
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(path):
+        print('converting %s to %d Hz' % (filepath, sample_rate))
+        _convert_file(filepath, path, sample_rate)
+    return path
+
+def _is_wave_at_rate(filepath, sample_rate):
+    try:
+        with open(filepath, 'rb') as f:
+            (num_channels, sr, sampwidth), offset, size = _read_wave_chunks(f)
+        return sr == sample_rate and sampwidth == 2
+    except (IOError, struct.error):
+        return False
+
+def _hash_file(filepath):
+    global g_file_hashes
+    if g_file_hashes is None:
+        g_file_hashes = _load_hash_index()
+
+    path = os.path.abspath(filepath)
+    st = os.stat(path)
+    entry = g_file_hashes.get(path)
+    if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    g_file_hashes[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    _save_hash_index()
+    return h.hexdigest()
+
+def _load_hash_index():
+    try:
+        with open(os.path.join(CACHE_DIR, kHashIndex)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _save_hash_index():
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    path = os.path.join(CACHE_DIR, kHashIndex)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(g_file_hashes, f)
+    os.replace(tmp, path)
+
+# decode, resample and write to dst_path. Written under a temporary name
+# first, so a partly written file is never used.
+def _convert_file(filepath, dst_path, sample_rate):
+    data, num_channels, sr = decode_file(filepath)
+    data = resample_array(data, num_channels, sr, sample_rate)
+
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    tmp = dst_path + '.tmp'
+    writer = WaveWriter(tmp, num_channels, sample_rate)
+    writer.write(data)
+    writer.close()
+    os.replace(tmp, dst_path)
+
+def decode_wave(filepath):
+    samples, num_channels, sampwidth, sr = map_wave_file(filepath)
+    if sampwidth != 2:
+        raise IOError('only 16-bit wave files are supported: ' + filepath)
+    data = samples.astype(np.float32)
+    data *= kInt16Scale
+    return data, num_channels, sr
+
+def decode_soundfile(filepath):
+    data, sr = soundfile.read(filepath, dtype='float32', always_2d=True)
+    return data.ravel(), data.shape[1], sr
+
+# decode with the flac tool into an in-memory wave file
+def decode_flac_tool(filepath):
+    wav_bytes = subprocess.check_output(['flac', '--decode', '--silent', '--stdout', filepath])
+    w = wave.open(io.BytesIO(wav_bytes))
+    num_channels, sampwidth, sr, num_frames = w.getparams()[:4]
+    if sampwidth != 2:
+        raise IOError('only 16-bit flac files are supported: ' + filepath)
+    data = np.frombuffer(w.readframes(num_frames), dtype='<i2').astype(np.float32)
+    data *= kInt16Scale
+    return data, num_channels, sr
+
+register_decoder(('.wav', '.wave'), decode_wave)
+if soundfile:
+    register_decoder(('.flac', '.ogg', '.oga'), decode_soundfile)
+elif shutil.which('flac'):
+    register_decoder(('.flac',), decode_flac_tool)
+
+
 # We can generalize the thing that WaveFile does - it provides arbitrary wave
 # data. We can define a "wave data providing interface" (called WaveSource)
 # if it can support the function:
@@ -53,14 +324,15 @@ class WaveFile(object):
 #
 # Now create WaveBuffer. Same WaveSource interface, but can take a subset of
 # audio data from a wave file and holds all that data in memory.
+# The data comes from g_wave_cache, so all WaveBuffers of the same file are
+# slices of one decoded array and the file is only read once.
 class WaveBuffer(object):
-    def __init__(self, filepath, start_frame, num_frames):
+    def __init__(self, filepath, start_frame = 0, num_frames = None):
         super(WaveBuffer, self).__init__()
 
-        # get a local copy of the audio data from WaveFile
-        wr = WaveFile(filepath)
-        self.data = wr.get_frames(start_frame, start_frame + num_frames)
-        self.num_channels = wr.get_num_channels()
+        # get a view of the audio data from the shared cache
+        self.data, self.num_channels = \
+            g_wave_cache.get_region(filepath, start_frame, num_frames)
 
     # start and end args are in units of frames,
     # so take into account num_channels when accessing sample data
@@ -73,6 +345,320 @@ class WaveBuffer(object):
         return self.num_channels
 
 
+# Process-wide cache of decoded audio files (float32, interleaved, at
+# Audio.sample_rate), keyed by path. Any format with a decoder (see
+# decode_file()) can be loaded. Regions are returned as read-only views of the
+# decoded file. When the total size goes over max_bytes, the least recently
+# used files are dropped from the cache (WaveBuffers still using them keep their
+# data alive).
+# If scratch_dir is set, decoded files are also written there as float32 .npy
+# files and memory-mapped back, so long songs are paged in by the OS instead of
+# held in memory, and a file is only decoded again if it changes.
+class WaveCache(object):
+    def __init__(self, max_bytes = 512 * 1024 * 1024, scratch_dir = None):
+        super(WaveCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.scratch_dir = scratch_dir
+        self.num_bytes = 0
+        self.entries = OrderedDict() # path -> (data, num_channels)
+
+    # returns (data, num_channels) for the region of the file starting at
+    # start_frame, num_frames long (or to the end of the file if None)
+    def get_region(self, filepath, start_frame = 0, num_frames = None):
+        data, num_channels = self.get_file(filepath)
+
+        start = start_frame * num_channels
+        if num_frames is None:
+            return data[start:], num_channels
+        else:
+            return data[start : start + num_frames * num_channels], num_channels
+
+    # returns (data, num_channels) for the whole file, decoding it if needed
+    def get_file(self, filepath):
+        path = os.path.abspath(filepath)
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = self._decode(path)
+            self.entries[path] = entry
+            self.num_bytes += _num_bytes(entry[0])
+            self._evict()
+        else:
+            self.entries.move_to_end(path)
+        return entry
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def set_scratch_dir(self, scratch_dir):
+        self.scratch_dir = scratch_dir
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def _decode(self, path):
+        if self.scratch_dir:
+            return self._decode_scratch(path)
+
+        data, num_channels = load_audio_file(path)
+        data.flags.writeable = False
+        return (data, num_channels)
+
+    # decode to (or reuse) a scratch file, and map it. The scratch file name
+    # depends on the file's path, size, modification time and the sample rate.
+    # Memory-mapped data does not count towards max_bytes. Data that comes
+    # back from load_audio_file() already mapped (a resampled file in
+    # CACHE_DIR) is used as is rather than copied again.
+    def _decode_scratch(self, path):
+        st = os.stat(path)
+        key = repr((path, st.st_size, st.st_mtime, Audio.sample_rate))
+        name = hashlib.sha1(key.encode()).hexdigest()
+        scratch = os.path.join(self.scratch_dir, 'decoded_%s.npy' % name)
+
+        if not os.path.exists(scratch):
+            data, num_channels = load_audio_file(path)
+            if _num_bytes(data) == 0:
+                return (data, num_channels)
+            frames = data.reshape(-1, num_channels)
+            if not os.path.exists(self.scratch_dir):
+                os.makedirs(self.scratch_dir)
+            # write under a temporary name, so a partial file is never used
+            tmp = scratch + '.tmp.npy'
+            np.save(tmp, frames)
+            os.replace(tmp, scratch)
+
+        frames = np.load(scratch, mmap_mode='r')
+        return (frames.reshape(-1), frames.shape[1])
+
+    # drop least recently used files, but never the one just added
+    def _evict(self):
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            path, (data, num_channels) = self.entries.popitem(last=False)
+            self.num_bytes -= _num_bytes(data)
+
+# memory held by data (memory-mapped data is not held)
+def _num_bytes(data):
+    return 0 if isinstance(data.base, np.memmap) or isinstance(data, np.memmap) else data.nbytes
+
+
+g_wave_cache = WaveCache()
+
+
+# Several aligned audio files (ie, the stems of a song) as one WaveSource: frame
+# i holds frame i of every stem, one stem after another, so all stems are read
+# with a single get_frames() call. Stems must have the same number of channels.
+# Shorter stems are padded with silence.
+# The combined data is kept as 16-bit samples (like the converted wave files of
+# get_wave_at_rate()), so it takes about as much space as the stems' wave files.
+# It is written once to CACHE_DIR and memory-mapped, named by the stems'
+# contents and the sample rate. With disk_cache = False, it is built in memory
+# instead.
+class StemSource(object):
+    def __init__(self, filepaths, disk_cache = True):
+        super(StemSource, self).__init__()
+        self.num_stems = len(filepaths)
+        frames = self._load(filepaths, disk_cache)
+
+        self.data = frames.reshape(-1)
+        self.num_channels = frames.shape[1]
+        self.stem_channels = self.num_channels // self.num_stems
+        self.end = frames.shape[0]
+
+    def get_frames(self, start_frame, end_frame) :
+        raw = self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+        samples = raw.astype(np.float32)
+        samples *= kInt16Scale
+        return samples
+
+    def get_frames_into(self, output, start_frame, end_frame) :
+        raw = self.data[start_frame * self.num_channels : end_frame * self.num_channels]
+        n = len(raw)
+        np.multiply(raw, kInt16Scale, out=output[:n], dtype=np.float32)
+        return n // self.num_channels
+
+    # channels of all stems together
+    def get_num_channels(self):
+        return self.num_channels
+
+    def get_num_stems(self):
+        return self.num_stems
+
+    # channels of one stem
+    def get_stem_channels(self):
+        return self.stem_channels
+
+    def _load(self, filepaths, disk_cache):
+        path = None
+        if disk_cache:
+            key = repr(([_hash_file(f) for f in filepaths], Audio.sample_rate))
+            name = 'stems16_%s.npy' % hashlib.sha1(key.encode()).hexdigest()
+            path = os.path.join(CACHE_DIR, name)
+            if os.path.exists(path):
+                return np.load(path, mmap_mode='r')
+
+        stems = [load_audio_file(f) for f in filepaths]
+        nc = stems[0][1]
+        assert all(c == nc for (d, c) in stems), 'stems must have the same number of channels'
+        num_frames = max(len(d) // nc for (d, c) in stems)
+
+        frames = np.zeros((num_frames, nc * len(stems)), dtype=np.int16)
+        for i, (d, c) in enumerate(stems):
+            stem = np.rint(d.reshape(-1, nc) * 32768.)
+            np.clip(stem, -32768, 32767, out=stem)
+            frames[:len(stem), i * nc : (i + 1) * nc] = stem
+
+        if path is None:
+            return frames
+
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp = path + '.tmp.npy'
+        np.save(tmp, frames)
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+
+# Wraps another WaveSource (ie, WaveFile, MappedWaveFile) and reads it ahead on
+# a worker thread, so the audio thread never waits on the disk. The source is
+# read in chunks of chunk_frames into a ring of float32 chunks covering about
+# read_ahead seconds from the current read position. The first chunk is read
+# right away and always kept, so starting over (reset, looping) never waits.
+#
+# get_frames() / get_frames_into() never block: if the frames asked for are not
+# loaded yet, they come back as silence and are counted in underruns. Only
+# the worker thread reads from the wrapped source. Call close() when done with
+# it, to end the worker thread.
+class PrefetchWaveSource(object):
+    def __init__(self, source, read_ahead = 2.0, chunk_frames = 16384):
+        super(PrefetchWaveSource, self).__init__()
+        self.source = source
+        self.num_channels = source.get_num_channels()
+        self.chunk_frames = chunk_frames
+        self.underruns = 0
+
+        # one slot per chunk in the read-ahead window, plus one for the chunk
+        # being read now. slot_chunk[s] is the chunk index held in slot s (or
+        # -1 while being loaded) and slot_frames[s] its number of frames.
+        num_slots = int(np.ceil(read_ahead * Audio.sample_rate / chunk_frames)) + 1
+        self.slots = np.zeros((num_slots, chunk_frames * self.num_channels), dtype=np.float32)
+        self.slot_chunk = [-1] * num_slots
+        self.slot_frames = [0] * num_slots
+
+        self.head = np.zeros(chunk_frames * self.num_channels, dtype=np.float32)
+        self.head_frames = self._load(0, self.head)
+
+        # frame that is expected to be read next
+        self.cursor = 0
+
+        self.running = True
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop the worker thread
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join()
+
+    # move the read position, so the worker starts reading ahead from there
+    def seek(self, frame):
+        self.cursor = frame
+        self.wake.set()
+
+    def get_frames(self, start_frame, end_frame) :
+        output = np.empty((end_frame - start_frame) * self.num_channels, dtype=np.float32)
+        n = self.get_frames_into(output, start_frame, end_frame)
+        return output[:n * self.num_channels]
+
+    # copy frames into output from the loaded chunks. Returns the number of
+    # frames written, which is less than asked for only at the end of the source.
+    def get_frames_into(self, output, start_frame, end_frame) :
+        nc = self.num_channels
+        frame = start_frame
+        while frame < end_frame:
+            chunk = frame // self.chunk_frames
+            offset = frame - chunk * self.chunk_frames
+            n = min(end_frame - frame, self.chunk_frames - offset)
+            dst = output[(frame - start_frame) * nc : (frame - start_frame + n) * nc]
+
+            if chunk == 0:
+                data, num_frames = self.head, self.head_frames
+            else:
+                slot = chunk % len(self.slots)
+                data, num_frames = self.slots[slot], self.slot_frames[slot]
+                if self.slot_chunk[slot] != chunk:
+                    data = None
+
+            if data is None:
+                dst.fill(0)
+                self.underruns += 1
+            else:
+                n = max(min(n, num_frames - offset), 0)
+                dst[:n * nc] = data[offset * nc : (offset + n) * nc]
+
+                # the worker may have reused the slot while we copied
+                if chunk != 0 and self.slot_chunk[slot] != chunk:
+                    dst.fill(0)
+                    self.underruns += 1
+
+                # short chunk: this is the end of the source
+                if num_frames < self.chunk_frames and offset + n >= num_frames:
+                    frame += n
+                    break
+
+            frame += n
+
+        # wake the worker when the cursor moves on to another chunk, so it
+        # refills the read-ahead window
+        old_chunk = self.cursor // self.chunk_frames
+        self.cursor = frame
+        if frame // self.chunk_frames != old_chunk:
+            self.wake.set()
+        return frame - start_frame
+
+    def get_num_channels(self):
+        return self.num_channels
+
+    # read chunk data from the source. Returns the number of frames read.
+    def _load(self, first_frame, data):
+        nc = self.num_channels
+        if hasattr(self.source, 'get_frames_into'):
+            return self.source.get_frames_into(data, first_frame, first_frame + self.chunk_frames)
+        frames = self.source.get_frames(first_frame, first_frame + self.chunk_frames)
+        data[:len(frames)] = frames
+        return len(frames) // nc
+
+    # keep the chunks from the cursor's chunk onward loaded, nearest first
+    def _worker(self):
+        num_slots = len(self.slots)
+        end_chunk = None
+        while self.running:
+            # cleared before reading, so that a wake-up during the reads is
+            # not lost
+            self.wake.clear()
+            first = self.cursor // self.chunk_frames
+            for chunk in range(max(first, 1), first + num_slots):
+                if not self.running or self.cursor // self.chunk_frames != first:
+                    break
+                if end_chunk is not None and chunk > end_chunk:
+                    break
+                slot = chunk % num_slots
+                if self.slot_chunk[slot] == chunk:
+                    continue
+
+                self.slot_chunk[slot] = -1
+                num_frames = self._load(chunk * self.chunk_frames, self.slots[slot])
+                self.slot_frames[slot] = num_frames
+                self.slot_chunk[slot] = chunk
+                if num_frames < self.chunk_frames:
+                    end_chunk = chunk
+
+            # sleep until get_frames_into(), seek() or close()
+            self.wake.wait()
+
 
 # simple class to hold a region: name, start frame, length (in frames)
 from collections import namedtuple
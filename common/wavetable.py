@@ -0,0 +1,83 @@
+import numpy as np
+import os
+import os.path
+import hashlib
+from .audio import Audio, CACHE_DIR
+
+# Band-limited wavetables. Instead of summing harmonics with np.sin every
+# buffer, a harmonics tuple (ie, NoteGenerator.saw) is rendered once into a
+# single-cycle table per octave, and notes are played back by interpolated
+# table lookup. Each octave's table only has the harmonics that stay below
+# Nyquist for the highest note in that octave, so high notes don't alias.
+
+kTableSize = 2048     # samples per cycle
+kLowestFreq = 16.0    # bottom of the first octave band (about C0)
+kNumOctaves = 11      # octave bands, up to 16 * 2^11 = 32768 Hz
+
+# tables already made, by (harmonics, sample_rate)
+g_wavetables = {}
+
+# return the tables for harmonics as an array of shape
+# (kNumOctaves, kTableSize + 1). The extra sample at the end of each table is a
+# copy of the first, so lookups can interpolate without wrapping.
+# if disk_cache is True, tables are also saved to / loaded from CACHE_DIR.
+def get_wavetables(harmonics, disk_cache = False):
+    key = (tuple(harmonics), Audio.sample_rate)
+    if key not in g_wavetables:
+        tables = _load_tables(key) if disk_cache else None
+        if tables is None:
+            tables = make_wavetables(harmonics, Audio.sample_rate)
+            if disk_cache:
+                _save_tables(key, tables)
+        g_wavetables[key] = tables
+    return g_wavetables[key]
+
+# return the single table to use for a note of frequency freq
+def get_wavetable(harmonics, freq, disk_cache = False):
+    return get_wavetables(harmonics, disk_cache)[get_octave(freq)]
+
+# which octave band freq falls in
+def get_octave(freq):
+    octave = int(np.floor(np.log2(freq / kLowestFreq)))
+    return int(np.clip(octave, 0, kNumOctaves - 1))
+
+# render harmonics into one table per octave band
+def make_wavetables(harmonics, sample_rate):
+    nyquist = sample_rate / 2.0
+    phase = np.arange(kTableSize + 1) * (2.0 * np.pi / kTableSize)
+
+    tables = np.zeros((kNumOctaves, kTableSize + 1))
+    for octave in range(kNumOctaves):
+        top_freq = kLowestFreq * 2 ** (octave + 1)
+        for (h, w) in enumerate(harmonics):
+            if w != 0 and (h + 1) * top_freq < nyquist:
+                tables[octave] += w * np.sin(phase * (h + 1))
+
+    return tables.astype(np.float32)
+
+# read table at phase (in cycles, in [0, 1)) with linear interpolation.
+# phase can be any shape.
+def wavetable_lookup(table, phase):
+    pos = phase * kTableSize
+    idx = pos.astype(np.intp)
+    frac = pos - idx
+    lo = table[idx]
+    return lo + frac * (table[idx + 1] - lo)
+
+def _cache_path(key):
+    name = hashlib.sha1(repr((key, kTableSize, kLowestFreq, kNumOctaves)).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, 'wavetable_%s.npy' % name)
+
+def _load_tables(key):
+    try:
+        return np.load(_cache_path(key))
+    except (IOError, ValueError):
+        return None
+
+def _save_tables(key, tables):
+    try:
+        if not os.path.exists(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        np.save(_cache_path(key), tables)
+    except IOError as e:
+        print('wavetable: could not save cache', e)
@@ -11,22 +11,47 @@
 import numpy as np
 import os.path
 import wave
+import time
+import threading
 from .audio import Audio
+from .ringbuf import RingBuffer
 
+# Captures audio (use add_audio as Audio's listen_func) to a file.
+#   stereo - keep both channels instead of just the left one
+#   streaming - instead of keeping all audio in memory until stop(), hand it
+#               to a background thread through a ring buffer of ring_seconds
+#               of audio, which appends it to an open wave file. Wave only.
 class AudioWriter(object):
-    def __init__(self, filebase, output_wave=True):
+    def __init__(self, filebase, output_wave=True, stereo=False, streaming=False, ring_seconds=2.0):
         super(AudioWriter, self).__init__()
+        assert(output_wave or not streaming)
         self.active = False
         self.buffers = []
         self.filebase = filebase
         self.output_wave = output_wave
+        self.stereo = stereo
+        self.num_channels = 1
+
+        # streaming mode
+        self.streaming = streaming
+        self.ring_seconds = ring_seconds
+        self.ring = None
+        self.thread = None
+        self.stopping = False
+        self.dropped = 0
 
     def add_audio(self, data, num_channels) :
         if self.active:
-            # only use a single channel if we are in stereo
-            if num_channels == 2:
+            # only use a single channel if we are in stereo, unless capturing stereo
+            if num_channels == 2 and not self.stereo:
                 data = data[0::2]
-            self.buffers.append(data)
+                num_channels = 1
+
+            if self.streaming:
+                self._stream_audio(data, num_channels)
+            else:
+                self.num_channels = num_channels
+                self.buffers.append(data)
 
     def toggle(self) :
         if self.active:
@@ -40,11 +65,18 @@ class AudioWriter(object):
             self.active = True
             self.buffers = []
 
+            if self.streaming:
+                self._start_streaming()
+
     def stop(self) :
         if self.active:
             print('AudioWriter: stop capture')
             self.active = False
 
+            if self.streaming:
+                self._stop_streaming()
+                return
+
             output = combine_buffers(self.buffers)
             if len(output) == 0:
                 print('AudioWriter: empty buffers. Nothing to write')
@@ -54,10 +86,63 @@ class AudioWriter(object):
             filename = self._get_filename(ext)
             print('AudioWriter: saving', len(output), 'samples in', filename)
             if self.output_wave:
-                write_wave_file(output, 1, filename)
+                write_wave_file(output, self.num_channels, filename)
             else:
                 np.save(filename, output)
 
+    # streaming mode: called from the audio side. Never blocks - if the ring
+    # is full (the disk can't keep up) the buffer is dropped and counted.
+    def _stream_audio(self, data, num_channels):
+        # channel count is fixed by the first buffer, before the writer thread
+        # can see any data
+        if self.ring.write_count == 0:
+            self.num_channels = num_channels
+        if not self.ring.write(data):
+            self.dropped += len(data)
+
+    def _start_streaming(self):
+        # whole stereo frames, so the writer never splits a frame
+        capacity = int(self.ring_seconds * Audio.sample_rate) * 2
+        self.ring = RingBuffer(capacity)
+        self.dropped = 0
+        self.stopping = False
+        self.filename = self._get_filename('wav')
+        self.thread = threading.Thread(target=self._writer_thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _stop_streaming(self):
+        # the writer thread empties the ring, then closes the file
+        self.stopping = True
+        self.thread.join()
+        self.thread = None
+        if self.dropped:
+            print('AudioWriter: dropped', self.dropped, 'samples (disk too slow)')
+
+    def _writer_thread(self):
+        writer = None
+        block = np.empty(8192, dtype=np.float32)
+        while True:
+            stopping = self.stopping
+            n = self.ring.read(block)
+            while n:
+                if writer is None:
+                    print('AudioWriter: streaming to', self.filename)
+                    writer = WaveWriter(self.filename, self.num_channels)
+                writer.write(block[:n])
+                n = self.ring.read(block)
+
+            # stopping was seen before the last read, so nothing is left
+            if stopping:
+                break
+            time.sleep(0.05)
+
+        if writer:
+            print('AudioWriter: saved', writer.num_samples, 'samples in', self.filename)
+            writer.close()
+        else:
+            print('AudioWriter: empty buffers. Nothing to write')
+
     # look for a filename that does not exist yet.
     def _get_filename(self, ext) :
         suffix = 1
@@ -68,6 +153,42 @@ class AudioWriter(object):
             else:
                 suffix += 1
 
+# Writes float audio data to a 16-bit wave file one buffer at a time, so the
+# whole file never has to be in memory. The wave header is patched with the
+# final length on close().
+class WaveWriter(object):
+    def __init__(self, filepath, num_channels, sample_rate = None):
+        super(WaveWriter, self).__init__()
+        self.wave = wave.open(filepath, 'wb')
+        self.wave.setnchannels(num_channels)
+        self.wave.setsampwidth(2)
+        self.wave.setframerate(sample_rate or Audio.sample_rate)
+        self.num_channels = num_channels
+        self.num_samples = 0
+
+        # conversion buffers, reused for every write
+        self.scaled = np.empty(0, dtype=np.float32)
+        self.samples = np.empty(0, dtype=np.int16)
+
+    # data is interleaved float audio in [-1, 1] (values outside are clipped)
+    def write(self, data):
+        n = len(data)
+        if len(self.scaled) < n:
+            self.scaled = np.empty(n, dtype=np.float32)
+            self.samples = np.empty(n, dtype=np.int16)
+
+        scaled = self.scaled[:n]
+        np.clip(data, -1.0, 1.0, out=scaled)
+        scaled *= 32767
+        samples = self.samples[:n]
+        samples[:] = scaled
+        self.wave.writeframes(samples)
+        self.num_samples += n
+
+    def close(self):
+        self.wave.close()
+
+
 def write_wave_file(buf, num_channels, name):
     f = wave.open(name, 'w')
     f.setnchannels(num_channels)
@@ -75,7 +196,7 @@ def write_wave_file(buf, num_channels, name):
     f.setframerate(Audio.sample_rate)
     buf = buf * (2**15)
     buf = buf.astype(np.int16)
-    f.writeframes(buf.tostring())
+    f.writeframes(buf.tobytes())
 
 # create single buffer from an array of buffers:
 def combine_buffers(buffers):
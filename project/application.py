@@ -104,9 +104,10 @@ class MainWidget(BaseWidget) :
         self.audio = Audio(2)
         self.synth = Synth('../data/FluidR3_GM.sf2')
 
-        # create TempoMap, AudioScheduler
+        # create TempoMap, AudioScheduler. The arpeggiators fire many notes per
+        # buffer, so let the synth render each buffer in one batch.
         self.tempo_map  = SimpleTempoMap(120)
-        self.sched = AudioScheduler(self.tempo_map)
+        self.sched = AudioScheduler(self.tempo_map, batch_events = True)
 
         # connect scheduler into audio system
         self.audio.set_generator(self.sched)
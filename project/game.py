@@ -6,8 +6,10 @@ from common.mixer import *
 from common.wavegen import *
 from common.wavesrc import *
 from common.gfxutil import *
+from common.perf import *
 from common.vecutil import *
 from project.graphics import *
+from project.timeline import GemTimeline
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
@@ -40,6 +42,12 @@ def parse_file(filepath):
             ] for t in tokens
         ]
 
+# seconds to fade between the solo and bg tracks on a hit or a miss
+kMuteRampTime = 0.03
+
+# stems of the song, in the order of song_path
+kBG, kSolo = 0, 1
+
 class AudioController(object):
     def __init__(self, audio, mixer, song_path):
         super(AudioController, self).__init__()
@@ -47,27 +55,67 @@ class AudioController(object):
         self.mixer = mixer
         self.audio.set_generator(self.mixer)
 
-        self.bg = WaveGenerator(WaveFile(song_path[0]))
-        self.mixer.add(self.bg)
-        self.solo = WaveGenerator(WaveFile(song_path[1]))
-        self.mixer.add(self.solo)
+        # the bg and solo tracks play as stems of one generator, so they stay
+        # sample-locked. The song is read ahead on a worker thread, so the
+        # audio never waits on the disk. It is paused before the audio thread
+        # can see it, so it doesn't play a buffer early.
+        self.source = PrefetchWaveSource(StemSource(song_path))
+        self.song = MultiTrackGenerator(self.source)
+        self.song.pause()
+        self.audio.post(self.mixer.add, self.song)
 
-        self.bg.pause()
-        self.solo.pause()
+        # PerfMonitor while monitoring is on (see toggle_monitor)
+        self.monitor = None
 
-    # start / stop the song
+    # start / stop the song. Changes are posted to the audio thread, so
+    # they happen between buffers.
     def toggle(self):
-        self.bg.play_toggle()
-        self.solo.play_toggle()
+        self.audio.post(self.song.play_toggle)
 
     # mute / unmute the solo track
     def set_mute(self, mute):
         if mute:
-            self.solo.set_gain(0.0)
-            self.bg.set_gain(0.6)
+            self.audio.post(self._set_gains, 0.0, 0.6)
         else:
-            self.solo.set_gain(1.0)
-            self.bg.set_gain(0.0)
+            self.audio.post(self._set_gains, 1.0, 0.0)
+
+    # crossfade instead of switching, so muting doesn't click
+    def _set_gains(self, solo_gain, bg_gain):
+        self.song.set_gain(kSolo, solo_gain, kMuteRampTime)
+        self.song.set_gain(kBG, bg_gain, kMuteRampTime)
+
+    # song position, in seconds, that the player is hearing right now
+    def get_time(self):
+        return self.song.get_time(self.audio.get_output_latency())
+
+    # song position of a tap that arrives now. Taps arrive input offset seconds
+    # after the player makes them (see calibrate.py), so this is what the
+    # player was hearing then.
+    def get_tap_time(self):
+        return self.get_time() - self.audio.get_input_offset()
+
+    # stop playing. The audio stream is shared by all games and keeps running
+    # (in callback mode), so it must stop pulling from this game's mixer.
+    def close(self):
+        self.audio.set_generator(None)
+        self.audio.post(self._set_monitor, None)
+        self.source.close()
+
+    # turn audio performance monitoring on / off. Audio and the mixer switch
+    # together on the audio thread, so every buffer is seen by both or neither.
+    def toggle_monitor(self):
+        self.monitor = None if self.monitor else PerfMonitor()
+        if self.monitor:
+            self.monitor.set_name(self.song, 'song')
+        self.audio.post(self._set_monitor, self.monitor)
+
+    def _set_monitor(self, monitor):
+        self.audio.set_monitor(monitor)
+        self.mixer.set_monitor(monitor)
+
+    # audio performance summary, or '' if monitoring is off
+    def get_perf_txt(self):
+        return self.monitor.get_txt() if self.monitor else ''
 
     # needed to update audio
     def on_update(self):
@@ -75,10 +123,10 @@ class AudioController(object):
 
             
 class Game(BaseWidget) :
-    def __init__(self, game_over_cb):
+    def __init__(self, audio, game_over_cb):
         super(Game, self).__init__()
         # AUDIO
-        self.audio = Audio(2)
+        self.audio = audio
         self.mixer = Mixer()
         AUDIO_PATH = ["./AloneFilteredv3.wav", "./AloneStandard.wav"]
         self.audio_ctrl = AudioController(self.audio, self.mixer, AUDIO_PATH)
@@ -89,8 +137,12 @@ class Game(BaseWidget) :
         self.player = PlayerDisplay()
         self.objects.add(self.player)
 
-        self.gem_data = deque(parse_file("./LevelFinal.txt"))
-        self.rendered_gems = deque()
+        # gems to show, in order of hit time, as (gem id, gem data). The
+        # timeline finds the gem hit by the laser among all the gems on screen.
+        gems = parse_file("./LevelFinal.txt")
+        self.timeline = GemTimeline([g[0] for g in gems], positions = [g[2] for g in gems])
+        self.gem_data = deque(sorted(enumerate(gems), key = lambda g: g[1][0]))
+        self.rendered_gems = {}
 
         self.camera = Camera(self.objects)
         self.canvas.add(self.camera)
@@ -114,6 +166,10 @@ class Game(BaseWidget) :
 
         self.first = True
 
+    # call when done with this game
+    def close(self):
+        self.audio_ctrl.close()
+
     def _get_multiplier(self):
         if self.combo < 5:
             return 1
@@ -149,6 +205,10 @@ class Game(BaseWidget) :
             self.toggle()
             self.audio_ctrl.toggle()
 
+        # audio performance overlay
+        if keycode[1] == 'i':
+            self.audio_ctrl.toggle_monitor()
+
         movement = lookup(keycode[1], 'wasd',
                 ((0.,1.), (-1.,0.), (0.,-1.), (1.,0.)))
         if movement is not None:
@@ -188,13 +248,16 @@ class Game(BaseWidget) :
                 self.healthbar
             ) if self.healthbar > 0 else "GAME OVER"
         )
+        self.label.text += "\n" + self.audio_ctrl.get_perf_txt()
 
         # Check paused state
         if not self.playing:
             return
 
+        # game time follows the song, as heard, rather than adding up frame
+        # times, which would drift away from the audio
         dt = kivyClock.frametime
-        self.time += dt
+        self.time = self.audio_ctrl.get_time()
 
         # Check laser usage
         if self.player.shooting:
@@ -202,18 +265,21 @@ class Game(BaseWidget) :
             self.healthbar_sprite.set_health(self.healthbar)
 
         # Render new gems
-        if len(self.gem_data) > 0 and self.gem_data[0][0] - self.time <= 5:
-            new_gem = GemDisplay(self.time, *self.gem_data.popleft(), self.spawn_bullets)
-            self.rendered_gems.append(new_gem)
+        if len(self.gem_data) > 0 and self.gem_data[0][1][0] - self.time <= 5:
+            gem_id, data = self.gem_data.popleft()
+            new_gem = GemDisplay(self.time, *data, self.spawn_bullets)
+            self.rendered_gems[gem_id] = new_gem
             self.objects.add(new_gem)
 
-        # Check hit gems
+        # Check hit gems. Hits are judged at the time the player acted, which
+        # corrects for input latency.
+        tap_time = self.audio_ctrl.get_tap_time()
         if self.player.shooting and len(self.rendered_gems) > 0:
             ray = (self.player.pos, self.player.dir)
-            d = dist_from_ray(*ray, self.rendered_gems[0].pos)
-            if d != False and d < 50. \
-                    and abs(self.time-self.rendered_gems[0].hit_time) < 0.2:
-                hit_gem = self.rendered_gems.popleft()
+            gem_id = self.timeline.nearest(tap_time, 0.2, ray = ray, max_dist = 50.)
+            if gem_id in self.rendered_gems:
+                self.timeline.resolve(gem_id)
+                hit_gem = self.rendered_gems.pop(gem_id)
                 hit_gem.on_hit()
                 self.audio_ctrl.set_mute(False)
                 self.healthbar = min(self.healthbar+1, 10)
@@ -222,9 +288,9 @@ class Game(BaseWidget) :
                 self.combo += 1
 
         # Check passed gems
-        if len(self.rendered_gems) > 0:
-            if self.time - self.rendered_gems[0].hit_time > 0.2:
-                passed_gem = self.rendered_gems.popleft()
+        for gem_id in self.timeline.pop_passed(tap_time - 0.2):
+            passed_gem = self.rendered_gems.pop(gem_id, None)
+            if passed_gem is not None:
                 passed_gem.on_pass()
                 self.audio_ctrl.set_mute(True)
                 self.healthbar = max(self.healthbar-0.5, 0)
@@ -306,6 +372,10 @@ class ScoreScreen(BaseWidget):
 class MainWidget(BaseWidget):
     def __init__(self):
         super(MainWidget, self).__init__()
+        # one audio stream for every game. It runs on its own thread, so a slow
+        # frame can't cause a dropout and we can afford a smaller buffer for
+        # lower latency
+        self.audio = Audio(2, use_callback=True, buffer_size=256)
         self.initialize()
 
     def initialize(self):
@@ -314,10 +384,11 @@ class MainWidget(BaseWidget):
 
     def start_game(self, inst):
         self.remove_widget(self.state)
-        self.state = Game(self.game_over)
+        self.state = Game(self.audio, self.game_over)
         self.add_widget(self.state)
 
     def game_over(self, score):
+        self.state.close()
         self.remove_widget(self.state)
         self.state = ScoreScreen(score, self.start_game)
         self.add_widget(self.state)
@@ -8,7 +8,7 @@ from common.audio import *
 from common.writer import *
 from common.mixer import *
 from common.note import *
-from wavesrc import *
+from common.wavesrc import WaveBuffer
 
 from kivy.core.window import Window
 from kivy.graphics.instructions import InstructionGroup
@@ -85,7 +85,7 @@ class WaveGenerator(object):
         return (output, continue_flag)
 
 def sec_to_frames(sec):
-    return int(sec * 44100) # sampling rate is 44100 Hz
+    return int(sec * Audio.sample_rate)
 
 gem_timings = []
 # return a list of WaveBuffers
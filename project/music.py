@@ -9,11 +9,12 @@ from common.mixer import *
 from common.wavegen import *
 from common.wavesrc import *
 from common.gfxutil import *
+from common.perf import *
+from project.timeline import GemTimeline
 
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Color, Ellipse, Line, Rectangle
 from kivy.graphics import PushMatrix, PopMatrix, Translate, Scale, Rotate
-from kivy.clock import Clock as kivyClock
 
 import random
 import numpy as np
@@ -44,6 +45,10 @@ class MainWidget(BaseWidget) :
         if keycode[1] == 'p':
             self.player.toggle()
 
+        # audio performance overlay
+        if keycode[1] == 'i':
+            self.audio_ctrl.toggle_monitor()
+
         # button down
         button_idx = lookup(keycode[1], 'cvbnm', (0,1,2,3,4))
         if button_idx != None:
@@ -66,7 +71,14 @@ class MainWidget(BaseWidget) :
         self.label.text = "Time: {0:.1f}\n".format(self.player.time)
         self.label.text += "Score: {}\n".format(self.player.score)
         self.label.text += "Combo: {}\n".format(self.player.combo)
+        self.label.text += self.audio_ctrl.get_perf_txt()
+
+
+# seconds to fade the solo track in or out on a hit or a miss
+kMuteRampTime = 0.03
 
+# stems of the song, in the order of song_path
+kBG, kSolo = 0, 1
 
 # creates the Audio driver
 # creates a song and loads it with solo and bg audio tracks
@@ -78,30 +90,69 @@ class AudioController(object):
         self.mixer = Mixer()
         self.audio.set_generator(self.mixer)
 
-        self.bg = WaveGenerator(WaveFile(song_path[0]))
-        self.mixer.add(self.bg)
-        self.solo = WaveGenerator(WaveFile(song_path[1]))
-        self.mixer.add(self.solo)
+        # the bg and solo tracks play as stems of one generator, so they stay
+        # sample-locked. The song is read ahead on a worker thread, so the
+        # audio never waits on the disk.
+        self.source = PrefetchWaveSource(StemSource(song_path))
+        self.song = MultiTrackGenerator(self.source)
+        self.song.pause()
+        self.audio.post(self.mixer.add, self.song)
+
+        # PerfMonitor while monitoring is on (see toggle_monitor)
+        self.monitor = None
+
+        register_terminate_func(self.close)
 
-        self.bg.pause()
-        self.solo.pause()
+        # load the miss sound up front, so playing it doesn't touch the disk.
+        # sound fx play on a fixed set of voices, so rapid misses can't pile
+        # up generators in the mixer
+        self.miss_sfx = WaveBuffer("./MissSFX.wav")
+        self.sfx = VoicePool(4)
+        self.audio.post(self.mixer.add, self.sfx)
+
+    # end the song's read-ahead thread
+    def close(self):
+        self.source.close()
 
     # start / stop the song
     def toggle(self):
-        self.bg.play_toggle()
-        self.solo.play_toggle()
+        self.song.play_toggle()
 
-    # mute / unmute the solo track
+    # mute / unmute the solo track. Fades quickly instead of switching, so
+    # it doesn't click.
     def set_mute(self, mute):
         if mute:
-            self.solo.set_gain(0.0)
+            self.song.set_gain(kSolo, 0.0, kMuteRampTime)
         else:
-            self.solo.set_gain(1.0)
+            self.song.set_gain(kSolo, 1.0, kMuteRampTime)
 
     # play a sound-fx (miss sound)
     def play_sfx(self):
-        self.miss = WaveGenerator(WaveFile("./MissSFX.wav"))
-        self.mixer.add(self.miss)
+        self.sfx.trigger(self.miss_sfx)
+
+    # song position, in seconds, that the player is hearing right now
+    def get_time(self):
+        return self.song.get_time(self.audio.get_output_latency())
+
+    # song position of a tap that arrives now, corrected for input latency
+    def get_tap_time(self):
+        return self.get_time() - self.audio.get_input_offset()
+
+    # turn audio performance monitoring on / off. Audio and the mixer switch
+    # together on the audio thread, so every buffer is seen by both or neither.
+    def toggle_monitor(self):
+        self.monitor = None if self.monitor else PerfMonitor()
+        if self.monitor:
+            self.monitor.set_name(self.song, 'song')
+        self.audio.post(self._set_monitor, self.monitor)
+
+    def _set_monitor(self, monitor):
+        self.audio.set_monitor(monitor)
+        self.mixer.set_monitor(monitor)
+
+    # audio performance summary, or '' if monitoring is off
+    def get_perf_txt(self):
+        return self.monitor.get_txt() if self.monitor else ''
 
     # needed to update audio
     def on_update(self):
@@ -329,7 +380,12 @@ class Player(object):
 
         self.playing = False
         self.time = 0.0
-        self.idx = [0, 0, 0, 0, 0]
+
+        # every gem as (lane, index in lane). The timeline refers to gems by
+        # their index in this list.
+        self.gems = [(l, i) for l, lane in enumerate(gem_data.lanes) for i in range(len(lane))]
+        self.timeline = GemTimeline([gem_data.lanes[l][i] for l, i in self.gems],
+                                    lanes = [l for l, i in self.gems])
 
         self.score = 0
         self.combo = 0
@@ -349,19 +405,22 @@ class Player(object):
         self.audio_ctrl.toggle()
         self.display.toggle()
 
-    # called by MainWidget
+    # called by MainWidget. The press is judged at the time the player made
+    # it, which corrects for input latency.
     def on_button_down(self, lane):
+        tap_time = self.audio_ctrl.get_tap_time()
+        # the gem nearest the tap within the slop margin in the correct lane
+        gem = self.timeline.nearest(tap_time, SLOP_MARGIN, lane)
+
         # corner case for no more gems in the given lane
-        if len(self.gem_data.lanes[lane]) <= self.idx[lane]:
+        if gem is None and self.timeline.num_left(lane) == 0:
             self.display.on_button_down(lane, False)
             self.audio_ctrl.set_mute(True)
-        # check if a gem was within the slop margin in the correct lane
-        elif abs(self.time - self.gem_data.lanes[lane][self.idx[lane]]) < \
-                SLOP_MARGIN:
+        elif gem is not None:
             self.display.on_button_down(lane, True)
-            self.display.gem_hit(lane, self.idx[lane])
+            self.display.gem_hit(*self.gems[gem])
             self.audio_ctrl.set_mute(False)
-            self.idx[lane] += 1
+            self.timeline.resolve(gem)
 
             self.score += 50 * self._get_multiplier()
             self.combo += 1
@@ -381,18 +440,15 @@ class Player(object):
         if not self.playing:
             return
 
-        self.time += kivyClock.frametime
-        for l in range(5):
-            if len(self.gem_data.lanes[l]) <= self.idx[l]:
-                continue
-            if self.time - self.gem_data.lanes[l][self.idx[l]] > \
-                    SLOP_MARGIN:
-                self.display.gem_pass(l, self.idx[l])
-                self.audio_ctrl.set_mute(True)
-                self.audio_ctrl.play_sfx()
-                self.idx[l] += 1
-                
-                self.combo = 0
+        # follow the song, as heard, so that hit windows don't drift
+        self.time = self.audio_ctrl.get_time()
+        tap_time = self.audio_ctrl.get_tap_time()
+        for gem in self.timeline.pop_passed(tap_time - SLOP_MARGIN):
+            self.display.gem_pass(*self.gems[gem])
+            self.audio_ctrl.set_mute(True)
+            self.audio_ctrl.play_sfx()
+
+            self.combo = 0
 
         self.display.on_update()
         self.audio_ctrl.on_update()
@@ -0,0 +1,119 @@
+import numpy as np
+from common.vecutil import normalize
+
+
+# All the gems of a level, for finding which gem an input event hits.
+#
+# Gems are given as a list of hit times (plus, optionally, a lane and a screen
+# position for each), and are referred to by their index in that list (the gem
+# id). Internally, they are kept sorted by hit time, so the gems in a time
+# window are found by binary search, and each lane keeps its own sorted times
+# the same way. Positions are kept in the same order, so the gems of a window
+# can be tested against a ray all at once.
+#
+# A gem is resolved when it is hit (resolve) or passed (pop_passed). Resolved
+# gems are never returned again.
+class GemTimeline(object):
+    def __init__(self, times, lanes = None, positions = None):
+        super(GemTimeline, self).__init__()
+        times = np.asarray(times, dtype=float)
+        self.order = np.argsort(times, kind='stable')     # gem id, by rank
+        self.rank = np.empty(len(times), dtype=np.intp)    # rank, by gem id
+        self.rank[self.order] = np.arange(len(times))
+        self.times = times[self.order]
+        self.active = np.ones(len(times), dtype=bool)
+        self.num_active = len(times)
+
+        # per lane: the ranks of the lane's gems, and their hit times
+        self.lanes = None
+        if lanes is not None:
+            self.lanes = np.asarray(lanes)[self.order]
+            self.lane_ranks = {}
+            self.lane_times = {}
+            self.lane_active = {}
+            for lane in np.unique(self.lanes):
+                ranks = np.flatnonzero(self.lanes == lane)
+                self.lane_ranks[lane] = ranks
+                self.lane_times[lane] = self.times[ranks]
+                self.lane_active[lane] = len(ranks)
+
+        self.positions = None
+        if positions is not None:
+            self.positions = np.asarray(positions, dtype=float)[self.order]
+
+        # gems before this rank have all been resolved
+        self.next_pass = 0
+
+    # number of gems not resolved yet (in lane, if given)
+    def num_left(self, lane = None):
+        if lane is None:
+            return self.num_active
+        return self.lane_active.get(lane, 0)
+
+    def get_time(self, gem_id):
+        return self.times[self.rank[gem_id]]
+
+    # ids of the unresolved gems with hit times in [t0, t1] (and in lane, if
+    # given), in order of hit time
+    def query(self, t0, t1, lane = None):
+        return self.order[self._window(t0, t1, lane)]
+
+    # id of the unresolved gem whose hit time is nearest to t, within window
+    # seconds either way, or None. Optionally, only gems in lane, and only gems
+    # within max_dist of ray, which is (origin, direction), and in front of it.
+    def nearest(self, t, window, lane = None, ray = None, max_dist = 0.):
+        ranks = self._window(t - window, t + window, lane)
+        if ray is not None and len(ranks):
+            ranks = ranks[self._near_ray(ranks, ray, max_dist)]
+        if len(ranks) == 0:
+            return None
+        best = ranks[np.argmin(np.abs(self.times[ranks] - t))]
+        return int(self.order[best])
+
+    # mark a gem as hit, so it won't be found again
+    def resolve(self, gem_id):
+        self._deactivate(self.rank[gem_id])
+
+    # resolve the gems with hit times before t that are not resolved yet, and
+    # return their ids, in order of hit time. Call with the current time minus
+    # the hit window to find the gems that went by without being hit.
+    def pop_passed(self, t):
+        passed = []
+        while self.next_pass < len(self.times) and self.times[self.next_pass] < t:
+            r = self.next_pass
+            if self.active[r]:
+                self._deactivate(r)
+                passed.append(int(self.order[r]))
+            self.next_pass += 1
+        return passed
+
+    # ranks of the unresolved gems in [t0, t1]
+    def _window(self, t0, t1, lane):
+        if lane is None:
+            lo = np.searchsorted(self.times, t0, 'left')
+            hi = np.searchsorted(self.times, t1, 'right')
+            ranks = np.arange(max(lo, self.next_pass), hi)
+        else:
+            if lane not in self.lane_times:
+                return np.empty(0, dtype=np.intp)
+            times = self.lane_times[lane]
+            lo = np.searchsorted(times, t0, 'left')
+            hi = np.searchsorted(times, t1, 'right')
+            ranks = self.lane_ranks[lane][lo:hi]
+        return ranks[self.active[ranks]]
+
+    # mask of ranks whose positions are in front of ray and within max_dist of it
+    def _near_ray(self, ranks, ray, max_dist):
+        origin, direction = ray
+        direction = normalize(np.asarray(direction, dtype=float))
+        rel = self.positions[ranks] - origin
+        proj = rel.dot(direction)
+        dist = np.linalg.norm(rel - proj[:, np.newaxis] * direction, axis=1)
+        return (proj >= 0) & (dist < max_dist)
+
+    def _deactivate(self, r):
+        if self.active[r]:
+            self.active[r] = False
+            self.num_active -= 1
+            if self.lanes is not None:
+                self.lane_active[self.lanes[r]] -= 1
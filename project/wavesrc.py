@@ -2,7 +2,7 @@
 
 import numpy as np
 import wave
-from common.audio import Audio
+from common.wavesrc import get_wave_at_rate
 
 
 # a generator that reads a file and can play it back
@@ -10,14 +10,12 @@ class WaveFileGenerator(object):
     def __init__(self, filepath):
         super(WaveFileGenerator, self).__init__()
 
-        self.wave = wave.open(filepath)
+        # files at other sample rates are read from a copy converted to
+        # Audio.sample_rate (made once, and kept in the audio cache)
+        self.wave = wave.open(get_wave_at_rate(filepath))
         self.num_channels, self.sampwidth, self.sr, self.end, \
            comptype, compname = self.wave.getparams()
 
-        # for now, we will only accept 16 bit files at 44k
-        assert(self.sampwidth == 2)
-        assert(self.sr == Audio.sample_rate)
-
         # for testing end of file...
         # self.wave.setpos(int(4.35 * 60 * Audio.sample_rate))
 
@@ -29,7 +27,7 @@ class WaveFileGenerator(object):
         raw_bytes = self.wave.readframes(num_frames)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        output = np.fromstring(raw_bytes, dtype = np.int16)
+        output = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         output = output.astype(np.float32)
@@ -49,14 +47,11 @@ class WaveFile(object):
     def __init__(self, filepath) :
         super(WaveFile, self).__init__()
 
-        self.wave = wave.open(filepath)
+        # files at other sample rates are read from a converted copy, as above
+        self.wave = wave.open(get_wave_at_rate(filepath))
         self.num_channels, self.sampwidth, self.sr, self.end, \
            comptype, compname = self.wave.getparams()
 
-        # for now, we will only accept 16 bit files at 44k
-        assert(self.sampwidth == 2)
-        assert(self.sr == 44100)
-
     # read an arbitrary chunk of data from the file
     def get_frames(self, start_frame, end_frame) :
         # get the raw data from wave file as a byte string. If asking for more than is available, it just
@@ -65,7 +60,7 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(end_frame - start_frame)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         samples = samples.astype(np.float32)